@@ -42,6 +42,9 @@ class EmonicRestful:
         self.url_map.add(rule_obj)
         self.resources[endpoint] = resource
 
+    def use(self, middleware):
+        self.middlewares.append(middleware)
+
     def errorhandler(self, code):
         def decorator(func):
             self.add_error_handler(code, func)
@@ -155,17 +158,21 @@ class EmonicRestful:
 
     def run(self, host='localhost', port=3000, debug=False):
         self.debug = debug
+        # serve self, not wsgi_app, so middleware installed with use() runs
         if debug:
-            app = DispatcherMiddleware(self.wsgi_app, {'/__debug__': ProfilerMiddleware(self.wsgi_app)})
+            app = DispatcherMiddleware(self, {'/__debug__': ProfilerMiddleware(self)})
             from werkzeug.debug import DebuggedApplication
             app = DebuggedApplication(app, evalex=True)
         else:
-            app = self.wsgi_app
+            app = self
         from werkzeug.serving import run_simple
         run_simple(host, port, app, use_reloader=debug)
 
     def __call__(self, environ, start_response):
-        return self.wsgi_app(environ, start_response)
+        app = self.wsgi_app
+        for middleware in reversed(self.middlewares):
+            app = middleware(app)
+        return app(environ, start_response)
 
 class Resource:
     def __init__(self, app):
@@ -1,142 +1,417 @@
+import asyncio
+import bisect
 import hashlib
+import inspect
 import json
+import math
+import random
+import secrets
+import threading
 import time
+import weakref
 from functools import wraps
+from .cache_backends import MemoryBackend
+
+_MISSING = object()
+_FRESH = 'fresh'
+_STALE = 'stale'
+_MISS = 'miss'
+
+class _Flight:
+    # One in-progress computation of a key; concurrent callers wait on it
+    # instead of recomputing the same value.
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class CacheStats:
+    # Counters and a compute-time histogram for one cached function.
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.compute_count = 0
+        self.compute_sum = 0.0
+        self.compute_buckets = [0] * len(self.BUCKETS)
+
+    def record(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def observe(self, seconds):
+        with self._lock:
+            self.compute_count += 1
+            self.compute_sum += seconds
+            self.compute_buckets[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.hits + self.stale + self.misses + self.coalesced
+            cumulative = 0
+            histogram = []
+            for bound, count in zip(self.BUCKETS, self.compute_buckets):
+                cumulative += count
+                histogram.append((bound, cumulative))
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'coalesced': self.coalesced,
+                'errors': self.errors,
+                'hit_rate': (self.hits + self.stale) / lookups if lookups else 0.0,
+                'compute_count': self.compute_count,
+                'compute_seconds': self.compute_sum,
+                'compute_histogram': histogram,
+            }
 
 class EmonicCache:
-    def __init__(self, cache_duration=300):
-        self.cache = {}
+    def __init__(self, cache_duration=300, early_expiration=1.0, stale_while_revalidate=None, backend=None):
+        # any object with get/set/delete/clear, see cache_backends
+        self.cache = backend if backend is not None else MemoryBackend()
         self.cache_duration = cache_duration
-    
+        # beta of the probabilistic early expiration; 0 disables it
+        self.early_expiration = early_expiration
+        # seconds past expiry during which the old value is served while
+        # a single background thread refreshes it; None disables it
+        self.stale_while_revalidate = stale_while_revalidate
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._async_flights = weakref.WeakKeyDictionary()
+        self._namespaces = {}
+        self._stats = {}
+
     def _generate_key(self, func_name, args, kwargs):
+        namespace = self._namespaces.get(func_name)
+        if namespace is not None:
+            func_name = f"{func_name}@{self._generation(namespace)}"
         key = f"{func_name}#{args}#{kwargs}"
         return hashlib.sha256(key.encode()).hexdigest()
-    
-    def get(self, timeout=None, key_prefix='Emonic', unless=None):
-        def decorator(func):
+
+    def _generation_key(self, namespace, kind='generation'):
+        return f"__emonic_{kind}__#{namespace}"
+
+    def _generation(self, namespace, kind='generation'):
+        # The generation lives in the backend so every worker sharing it sees
+        # a bump. A missing counter (never set, or evicted) gets a fresh random
+        # value, which can never match keys built from an older generation.
+        entry = self.cache.get(self._generation_key(namespace, kind))
+        if entry is None:
+            return self._bump_generation(namespace, kind)
+        return entry[0]
+
+    def _bump_generation(self, namespace, kind='generation'):
+        generation = secrets.token_hex(8)
+        self.cache.set(self._generation_key(namespace, kind), (generation, time.time(), 0.0), None)
+        return generation
+
+    def _register(self, func, namespace):
+        self._stats.setdefault(func.__name__, CacheStats())
+        if namespace is not None:
+            self._namespaces[func.__name__] = namespace
+
+    def _resolve_tags(self, tags, args, kwargs):
+        if tags is None:
+            return None
+        if callable(tags):
+            tags = tags(*args, **kwargs)
+        if isinstance(tags, str):
+            return (tags,)
+        return tuple(tags)
+
+    def _tag_names(self, tags):
+        # 'user:42' is also covered by the 'user:*' wildcard
+        names = []
+        for tag in tags:
+            names.append(tag)
+            group, sep, _ = tag.partition(':')
+            if sep:
+                names.append(f"{group}:*")
+        return names
+
+    def _tag_stamp(self, tags):
+        # Tag membership is recorded in the entry itself as the generation of
+        # each tag at store time, so it is shared through the backend like the
+        # value; invalidate_tags bumps the generation and older entries stop
+        # matching in every worker.
+        return tuple((name, self._generation(name, 'tag')) for name in dict.fromkeys(self._tag_names(tags)))
+
+    def _lookup(self, key, timeout, accept=None):
+        entry = self.cache.get(key)
+        if entry is None:
+            return _MISSING, _MISS
+        value, timestamp, delta = entry[:3]
+        if len(entry) > 3 and any(self._generation(name, 'tag') != generation for name, generation in entry[3]):
+            return _MISSING, _MISS
+        if accept is not None and not accept(value):
+            return value, _MISS
+        if timeout is None:
+            return value, _FRESH
+
+        age = time.time() - timestamp
+        # Recompute a little before expiry, more eagerly the longer the value
+        # took to compute, so one caller refreshes it before everyone misses.
+        jitter = -delta * self.early_expiration * math.log(1.0 - random.random())
+        if age + jitter <= timeout:
+            return value, _FRESH
+        if self.stale_while_revalidate is not None and age <= timeout + self.stale_while_revalidate:
+            return value, _STALE
+        return value, _MISS
+
+    def _store(self, key, value, delta=0.0, timeout=None, stamp=None):
+        # stamp is taken before computing the value, so an invalidation that
+        # lands while it is being computed still applies to it
+        ttl = timeout
+        if ttl is not None and self.stale_while_revalidate is not None:
+            ttl += self.stale_while_revalidate
+        if stamp:
+            entry = (value, time.time(), delta, stamp)
+        else:
+            entry = (value, time.time(), delta)
+        self.cache.set(key, entry, ttl)
+
+    def _begin_flight(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = _Flight()
+            return flight, True
+
+    def _run_flight(self, key, flight, func, args, kwargs, timeout, store_if, tags):
+        stats = self._stats[func.__name__]
+        try:
+            stamp = self._tag_stamp(tags) if tags else None
+            start = time.time()
+            result = func(*args, **kwargs)
+            delta = time.time() - start
+            stats.observe(delta)
+            if store_if is None or store_if(result):
+                self._store(key, result, delta, timeout, stamp)
+            flight.result = result
+            return result
+        except BaseException as e:
+            stats.record('errors')
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    def _refresh(self, key, func, args, kwargs, timeout, store_if, tags):
+        flight, leader = self._begin_flight(key)
+        if not leader:
+            return
+
+        def run():
+            try:
+                self._run_flight(key, flight, func, args, kwargs, timeout, store_if, tags)
+            except Exception:
+                pass
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _cached_call(self, key, func, args, kwargs, timeout, store_if=None, accept=None, tags=None):
+        stats = self._stats[func.__name__]
+        value, state = self._lookup(key, timeout, accept)
+        if state is _FRESH:
+            stats.record('hits')
+            return value
+        if state is _STALE:
+            stats.record('stale')
+            self._refresh(key, func, args, kwargs, timeout, store_if, self._resolve_tags(tags, args, kwargs))
+            return value
+
+        flight, leader = self._begin_flight(key)
+        if not leader:
+            stats.record('coalesced')
+            return flight.wait()
+        stats.record('misses')
+        return self._run_flight(key, flight, func, args, kwargs, timeout, store_if, self._resolve_tags(tags, args, kwargs))
+
+    def _async_flight(self, key, func, args, kwargs, timeout, store_if, tags):
+        # Flights are per event loop: a task can only be awaited on its own loop.
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            flights = self._async_flights.get(loop)
+            if flights is None:
+                flights = self._async_flights[loop] = {}
+            task = flights.get(key)
+            if task is not None:
+                return task, False
+
+            stats = self._stats[func.__name__]
+
+            async def compute():
+                stamp = self._tag_stamp(tags) if tags else None
+                start = time.time()
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception:
+                    stats.record('errors')
+                    raise
+                delta = time.time() - start
+                stats.observe(delta)
+                if store_if is None or store_if(result):
+                    self._store(key, result, delta, timeout, stamp)
+                return result
+
+            task = flights[key] = loop.create_task(compute())
+
+        def done(finished):
+            with self._lock:
+                if flights.get(key) is finished:
+                    del flights[key]
+            # retrieve the error so unawaited background refreshes don't warn
+            if not finished.cancelled():
+                finished.exception()
+
+        task.add_done_callback(done)
+        return task, True
+
+    async def _async_cached_call(self, key, func, args, kwargs, timeout, store_if=None, accept=None, tags=None):
+        stats = self._stats[func.__name__]
+        value, state = self._lookup(key, timeout, accept)
+        if state is _FRESH:
+            stats.record('hits')
+            return value
+        task, leader = self._async_flight(key, func, args, kwargs, timeout, store_if, self._resolve_tags(tags, args, kwargs))
+        if state is _STALE:
+            stats.record('stale')
+            return value
+        stats.record('misses' if leader else 'coalesced')
+        # Shielded so a cancelled caller leaves the shared computation running
+        # for the other waiters; a cancelled computation stores nothing.
+        return await asyncio.shield(task)
+
+    def _decorate(self, func, timeout, store_if=None, accept=None, tags=None, namespace=None):
+        self._register(func, namespace)
+
+        if inspect.iscoroutinefunction(func):
             @wraps(func)
-            def wrapper(*args, **kwargs):
+            async def async_wrapper(*args, **kwargs):
                 key = self._generate_key(func.__name__, args, kwargs)
-                
-                if key in self.cache:
-                    cached_result, timestamp = self.cache[key]
-                    if timeout is None or time.time() - timestamp <= timeout:
-                        return cached_result
-                
-                result = func(*args, **kwargs)
-                if unless is None or not unless(result):
-                    self.cache[key] = (result, time.time())
-                return result
-            
-            return wrapper
-        
+                return await self._async_cached_call(key, func, args, kwargs, timeout, store_if, accept, tags)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = self._generate_key(func.__name__, args, kwargs)
+            return self._cached_call(key, func, args, kwargs, timeout, store_if, accept, tags)
+
+        return wrapper
+
+    def get(self, timeout=None, key_prefix='Emonic', unless=None, tags=None, namespace=None):
+        store_if = None if unless is None else (lambda result: not unless(result))
+
+        def decorator(func):
+            return self._decorate(func, timeout, store_if=store_if, tags=tags, namespace=namespace)
+
         return decorator
-    
+
     def clear_cache(self):
-        self.cache = {}
-    
+        self.cache.clear()
+
     def delete(self, func_name, *args, **kwargs):
         key = self._generate_key(func_name, args, kwargs)
-        if key in self.cache:
-            del self.cache[key]
-    
-    def memoize(self, timeout=None, key_prefix='Emonic'):
+        self.cache.delete(key)
+
+    def invalidate_tags(self, *tags):
+        # 'user:42' drops entries tagged exactly so; 'product:*' drops every
+        # entry carrying any 'product:' tag. O(len(tags)) and seen by every
+        # worker sharing the backend; the dropped entries age out on their own.
+        for tag in dict.fromkeys(tags):
+            self._bump_generation(tag, 'tag')
+        return len(tags)
+
+    def invalidate_namespace(self, namespace):
+        # O(1): every function decorated with this namespace starts using new
+        # keys; the old entries age out of the backend on their own.
+        self._bump_generation(namespace)
+
+    def memoize(self, timeout=None, key_prefix='Emonic', tags=None, namespace=None):
         def decorator(func):
-            @wraps(func)
-            def wrapper(*args, **kwargs):
-                key = self._generate_key(func.__name__, args, kwargs)
-                
-                if key in self.cache:
-                    cached_result, timestamp = self.cache[key]
-                    if timeout is None or time.time() - timestamp <= timeout:
-                        return cached_result
-                
-                result = func(*args, **kwargs)
-                self.cache[key] = (result, time.time())
-                return result
-            
-            return wrapper
-        
+            return self._decorate(func, timeout, tags=tags, namespace=namespace)
+
         return decorator
-    
-    def set(self, func_name, value, *args, **kwargs):
+
+    def set(self, func_name, value, *args, tags=None, **kwargs):
         key = self._generate_key(func_name, args, kwargs)
-        self.cache[key] = (value, time.time())
-    
-    def get_or_set(self, timeout=None, key_prefix='Emonic'):
+        tags = self._resolve_tags(tags, args, kwargs)
+        self._store(key, value, stamp=self._tag_stamp(tags) if tags else None)
+
+    def get_or_set(self, timeout=None, key_prefix='Emonic', tags=None, namespace=None):
         def decorator(func):
-            @wraps(func)
-            def wrapper(*args, **kwargs):
-                key = self._generate_key(func.__name__, args, kwargs)
-                
-                if key in self.cache:
-                    cached_result, timestamp = self.cache[key]
-                    if timeout is None or time.time() - timestamp <= timeout:
-                        return cached_result
-                
-                result = func(*args, **kwargs)
-                self.cache[key] = (result, time.time())
-                return result
-            
-            return wrapper
-        
+            return self._decorate(func, timeout, tags=tags, namespace=namespace)
+
         return decorator
-    
-    def cache_for(self, cache_duration):
+
+    def cache_for(self, cache_duration, tags=None, namespace=None):
         def decorator(func):
-            @wraps(func)
-            def wrapper(*args, **kwargs):
-                key = self._generate_key(func.__name__, args, kwargs)
-                
-                if key in self.cache:
-                    cached_result, timestamp = self.cache[key]
-                    if time.time() - timestamp <= cache_duration:
-                        return cached_result
-                
-                result = func(*args, **kwargs)
-                self.cache[key] = (result, time.time())
-                return result
-            
-            return wrapper
-        
+            return self._decorate(func, cache_duration, tags=tags, namespace=namespace)
+
         return decorator
-    
-    def cache_unless(self, condition):
+
+    def cache_unless(self, condition, tags=None, namespace=None):
+        keep = lambda result: not condition(result)
+
         def decorator(func):
-            @wraps(func)
-            def wrapper(*args, **kwargs):
-                key = self._generate_key(func.__name__, args, kwargs)
-                
-                if key in self.cache:
-                    cached_result, timestamp = self.cache[key]
-                    if not condition(cached_result):
-                        return cached_result
-                
-                result = func(*args, **kwargs)
-                if not condition(result):
-                    self.cache[key] = (result, time.time())
-                return result
-            
-            return wrapper
-        
+            return self._decorate(func, None, store_if=keep, accept=keep, tags=tags, namespace=namespace)
+
         return decorator
-    
-    def cache_if(self, condition):
+
+    def cache_if(self, condition, tags=None, namespace=None):
         def decorator(func):
-            @wraps(func)
-            def wrapper(*args, **kwargs):
-                key = self._generate_key(func.__name__, args, kwargs)
-                
-                if key in self.cache:
-                    cached_result, timestamp = self.cache[key]
-                    if condition(cached_result):
-                        return cached_result
-                
-                result = func(*args, **kwargs)
-                if condition(result):
-                    self.cache[key] = (result, time.time())
-                return result
-            
-            return wrapper
-        
+            return self._decorate(func, None, store_if=condition, accept=condition, tags=tags, namespace=namespace)
+
         return decorator
+
+    def stats(self, func_name=None):
+        backend_stats = getattr(self.cache, 'stats', None)
+        functions = {name: stats.snapshot() for name, stats in self._stats.items()
+                     if func_name is None or name == func_name}
+        return {
+            'functions': functions,
+            'backend': backend_stats() if backend_stats is not None else {},
+        }
+
+    def metrics(self, prefix='emonic_cache'):
+        # Prometheus text exposition of stats(); return it from a route to
+        # serve it, e.g. app.route('/metrics')(lambda request: cache.metrics()).
+        stats = self.stats()
+        lines = []
+        for counter in ('hits', 'misses', 'stale', 'coalesced', 'errors'):
+            lines.append(f"# TYPE {prefix}_{counter}_total counter")
+            for name, snapshot in stats['functions'].items():
+                lines.append(f'{prefix}_{counter}_total{{function="{name}"}} {snapshot[counter]}')
+        lines.append(f"# TYPE {prefix}_compute_seconds histogram")
+        for name, snapshot in stats['functions'].items():
+            for bound, count in snapshot['compute_histogram']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{prefix}_compute_seconds_bucket{{function="{name}",le="{le}"}} {count}')
+            lines.append(f'{prefix}_compute_seconds_sum{{function="{name}"}} {snapshot["compute_seconds"]}')
+            lines.append(f'{prefix}_compute_seconds_count{{function="{name}"}} {snapshot["compute_count"]}')
+        for name, value in self._flatten(stats['backend']):
+            lines.append(f"# TYPE {prefix}_backend_{name} gauge")
+            lines.append(f"{prefix}_backend_{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def _flatten(self, stats, prefix=''):
+        for name, value in stats.items():
+            if isinstance(value, dict):
+                yield from self._flatten(value, f"{prefix}{name}_")
+            else:
+                yield f"{prefix}{name}", value
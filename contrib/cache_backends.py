@@ -0,0 +1,327 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from .shared_files import SharedFile, SQLiteConnections
+
+def _expires_at(ttl):
+    return time.time() + ttl if ttl is not None else 0.0
+
+class MemoryBackend:
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # shallow sys.getsizeof of the stored values, an estimate only
+        self._bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _discard(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._bytes -= item[2]
+        return item
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            entry, expires, _ = item
+            if expires and expires < time.time():
+                self._discard(key)
+                self.expirations += 1
+                return None
+            if self.max_entries:
+                self._data.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, ttl=None):
+        size = sys.getsizeof(entry[0]) if isinstance(entry, tuple) and entry else sys.getsizeof(entry)
+        with self._lock:
+            self._discard(key)
+            self._data[key] = (entry, _expires_at(ttl), size)
+            self._bytes += size
+            if self.max_entries:
+                while len(self._data) > self.max_entries:
+                    self._discard(next(iter(self._data)))
+                    self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            return self._discard(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'bytes': self._bytes,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+class SharedMemoryBackend:
+    # Fixed-size open-addressing hash table in a memory-mapped file, shared by
+    # every worker process on the host that opens the same path. Each slot is
+    # a header (state, key digest, expiry, length) followed by the pickled
+    # entry; entries larger than a slot are not stored.
+    _MAGIC = b'EMCACHE1'
+    _HEADER = struct.Struct('<8sII')
+    _SLOT = struct.Struct('<B16sdI')
+    _EMPTY, _USED, _DELETED = 0, 1, 2
+
+    def __init__(self, path, slots=4096, slot_size=4096, max_probes=16):
+        self.path = path
+        self.max_probes = max_probes
+        # counted per process; the table itself is shared
+        self.evictions = 0
+        self.rejected = 0
+
+        self._shared = SharedFile(path)
+        file = self._shared.file
+        with self._shared.lock():
+            file.seek(0, os.SEEK_END)
+            if file.tell() < self._HEADER.size:
+                file.seek(0)
+                file.write(self._HEADER.pack(self._MAGIC, slots, slot_size))
+                file.truncate(self._HEADER.size + slots * slot_size)
+                file.flush()
+            file.seek(0)
+            magic, self.slots, self.slot_size = self._HEADER.unpack(file.read(self._HEADER.size))
+            if magic != self._MAGIC:
+                raise ValueError(f"'{path}' is not an Emonic shared cache file.")
+        self._shared.map(self._HEADER.size + self.slots * self.slot_size)
+
+    def _file_lock(self, exclusive):
+        return self._shared.lock(exclusive)
+
+    @property
+    def _map(self):
+        # reopened in forked workers, so always looked up through _shared
+        return self._shared.mmap
+
+    def _digest(self, key):
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+    def _offset(self, index):
+        return self._HEADER.size + index * self.slot_size
+
+    def _probe(self, digest):
+        start = int.from_bytes(digest[:8], 'little') % self.slots
+        for i in range(min(self.max_probes, self.slots)):
+            yield (start + i) % self.slots
+
+    def _find(self, digest):
+        for index in self._probe(digest):
+            state, slot_digest, expires, length = self._SLOT.unpack_from(self._map, self._offset(index))
+            if state == self._EMPTY:
+                return None
+            if state == self._USED and slot_digest == digest:
+                return index, expires, length
+        return None
+
+    def get(self, key):
+        digest = self._digest(key)
+        with self._file_lock(exclusive=False):
+            found = self._find(digest)
+            if found is None:
+                return None
+            index, expires, length = found
+            if expires and expires < time.time():
+                return None
+            start = self._offset(index) + self._SLOT.size
+            payload = self._map[start:start + length]
+        return pickle.loads(payload)
+
+    def set(self, key, entry, ttl=None):
+        payload = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        if self._SLOT.size + len(payload) > self.slot_size:
+            self.rejected += 1
+            return False
+        digest = self._digest(key)
+        now = time.time()
+        with self._file_lock(exclusive=True):
+            target = None
+            for index in self._probe(digest):
+                state, slot_digest, expires, _ = self._SLOT.unpack_from(self._map, self._offset(index))
+                if state == self._USED and slot_digest == digest:
+                    target = index
+                    break
+                if target is None and (state != self._USED or (expires and expires < now)):
+                    target = index
+                if state == self._EMPTY:
+                    break
+            if target is None:
+                # Probe window full of live entries: evict the first one.
+                target = next(self._probe(digest))
+                self.evictions += 1
+            offset = self._offset(target)
+            self._map[offset + self._SLOT.size:offset + self._SLOT.size + len(payload)] = payload
+            self._SLOT.pack_into(self._map, offset, self._USED, digest, _expires_at(ttl), len(payload))
+        return True
+
+    def delete(self, key):
+        digest = self._digest(key)
+        with self._file_lock(exclusive=True):
+            found = self._find(digest)
+            if found is None:
+                return False
+            self._SLOT.pack_into(self._map, self._offset(found[0]), self._DELETED, b'\0' * 16, 0.0, 0)
+        return True
+
+    def clear(self):
+        empty = b'\0' * self._SLOT.size
+        with self._file_lock(exclusive=True):
+            for index in range(self.slots):
+                offset = self._offset(index)
+                self._map[offset:offset + self._SLOT.size] = empty
+
+    def _scan(self):
+        now = time.time()
+        count = size = 0
+        with self._file_lock(exclusive=False):
+            for index in range(self.slots):
+                state, _, expires, length = self._SLOT.unpack_from(self._map, self._offset(index))
+                if state == self._USED and not (expires and expires < now):
+                    count += 1
+                    size += length
+        return count, size
+
+    def __len__(self):
+        return self._scan()[0]
+
+    def stats(self):
+        count, size = self._scan()
+        return {
+            'entries': count,
+            'bytes': size,
+            'capacity': self.slots,
+            'evictions': self.evictions,
+            'rejected': self.rejected,
+        }
+
+    def close(self):
+        self._shared.close()
+
+class SQLiteBackend:
+    # Disk-backed store shared by all processes that open the same file.
+    # Payloads larger than compress_threshold bytes are zlib-compressed.
+    def __init__(self, path, compress_threshold=1024, compress_level=6):
+        self.path = path
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self._connections = SQLiteConnections(path)
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS emonic_cache '
+            '(key TEXT PRIMARY KEY, expires REAL NOT NULL, compressed INTEGER NOT NULL, value BLOB NOT NULL)'
+        )
+        conn.commit()
+
+    def _connection(self):
+        return self._connections.get()
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT expires, compressed, value FROM emonic_cache WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        expires, compressed, value = row
+        if expires and expires < time.time():
+            self.delete(key)
+            return None
+        if compressed:
+            value = zlib.decompress(value)
+        return pickle.loads(value)
+
+    def set(self, key, entry, ttl=None):
+        value = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        compressed = 0
+        if self.compress_threshold is not None and len(value) > self.compress_threshold:
+            value = zlib.compress(value, self.compress_level)
+            compressed = 1
+        self._connection().execute(
+            'INSERT OR REPLACE INTO emonic_cache (key, expires, compressed, value) VALUES (?, ?, ?, ?)',
+            (key, _expires_at(ttl), compressed, sqlite3.Binary(value))
+        )
+        return True
+
+    def delete(self, key):
+        cursor = self._connection().execute('DELETE FROM emonic_cache WHERE key = ?', (key,))
+        return cursor.rowcount > 0
+
+    def clear(self):
+        self._connection().execute('DELETE FROM emonic_cache')
+
+    def purge_expired(self):
+        cursor = self._connection().execute(
+            'DELETE FROM emonic_cache WHERE expires != 0 AND expires < ?', (time.time(),)
+        )
+        return cursor.rowcount
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM emonic_cache').fetchone()[0]
+
+    def stats(self):
+        count, size, compressed = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0), COALESCE(SUM(compressed), 0) FROM emonic_cache'
+        ).fetchone()
+        return {'entries': count, 'bytes': size, 'compressed': compressed}
+
+class TieredBackend:
+    # In-process L1 in front of a shared L2. L1 entries live at most l1_ttl
+    # seconds so that writes from other workers become visible quickly.
+    def __init__(self, l2, l1=None, l1_ttl=5):
+        self.l1 = l1 if l1 is not None else MemoryBackend(max_entries=1024)
+        self.l2 = l2
+        self.l1_ttl = l1_ttl
+
+    def _l1_ttl(self, ttl):
+        if ttl is None:
+            return self.l1_ttl
+        return min(ttl, self.l1_ttl) if self.l1_ttl is not None else ttl
+
+    def get(self, key):
+        entry = self.l1.get(key)
+        if entry is not None:
+            return entry
+        entry = self.l2.get(key)
+        if entry is not None:
+            self.l1.set(key, entry, self.l1_ttl)
+        return entry
+
+    def set(self, key, entry, ttl=None):
+        self.l1.set(key, entry, self._l1_ttl(ttl))
+        return self.l2.set(key, entry, ttl)
+
+    def delete(self, key):
+        local = self.l1.delete(key)
+        return self.l2.delete(key) or local
+
+    def clear(self):
+        self.l1.clear()
+        self.l2.clear()
+
+    def __len__(self):
+        return len(self.l2)
+
+    def stats(self):
+        return {
+            'l1': self.l1.stats() if hasattr(self.l1, 'stats') else {},
+            'l2': self.l2.stats() if hasattr(self.l2, 'stats') else {},
+        }
@@ -0,0 +1,106 @@
+import mmap
+import os
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # without flock only the per-process thread lock applies
+    fcntl = None
+
+# Files and SQLite databases shared by the worker processes on one host.
+# flock does not exclude processes that share an open file description, and
+# an sqlite3 connection must not be used on both sides of a fork, so both
+# are reopened in a child process right after fork.
+
+class SharedFile:
+    # A file locked with flock, optionally with a shared mmap of its first
+    # map_size bytes (see map()). The file is unbuffered; append=True opens
+    # it in O_APPEND mode, so each write() lands whole at the current end.
+    def __init__(self, path, append=False):
+        self.path = path
+        self.append = append
+        self.map_size = None
+        self.mmap = None
+        self.file = None
+        self._lock = threading.Lock()
+        self.reopen()
+        _shared_files.add(self)
+
+    def reopen(self):
+        flags = os.O_RDWR | os.O_CREAT | (os.O_APPEND if self.append else 0)
+        fd = os.open(self.path, flags, 0o600)
+        old_file, old_map = self.file, self.mmap
+        self.file = os.fdopen(fd, 'r+b', buffering=0)
+        self.mmap = mmap.mmap(fd, self.map_size) if self.map_size else None
+        if old_map is not None:
+            old_map.close()
+        if old_file is not None:
+            old_file.close()
+
+    def map(self, size):
+        self.map_size = size
+        self.mmap = mmap.mmap(self.file.fileno(), size)
+        return self.mmap
+
+    def fileno(self):
+        return self.file.fileno()
+
+    @contextmanager
+    def lock(self, exclusive=True):
+        with self._lock:
+            file = self.file
+            if fcntl is None:
+                yield
+                return
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                # the caller may have reopened the file meanwhile
+                if not file.closed:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+        self.file.close()
+
+class SQLiteConnections:
+    # One WAL-mode connection per thread, and per process after a fork.
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._inherited = []
+        _shared_files.add(self)
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _after_fork(self):
+        # The parent's connection is kept referenced but unused: closing it
+        # here could touch the parent's WAL state.
+        self._inherited.append(self._local)
+        self._local = threading.local()
+
+_shared_files = weakref.WeakSet()
+
+def _reopen_shared_files():
+    for shared in list(_shared_files):
+        if isinstance(shared, SQLiteConnections):
+            shared._after_fork()
+        elif not shared.file.closed:
+            shared._lock = threading.Lock()
+            shared.reopen()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reopen_shared_files)
@@ -0,0 +1,277 @@
+import json
+import math
+import threading
+import time
+from ...Restful.env import ErrorHandlers
+
+LOW = 0
+NORMAL = 1
+CRITICAL = 2
+
+class FixedLimit:
+    def __init__(self, limit):
+        self.limit = limit
+
+    def update(self, latency, inflight, target_latency):
+        pass
+
+class AIMDLimit:
+    # Additive increase while saturated and fast, multiplicative decrease as
+    # soon as a request is slower than the target latency.
+    def __init__(self, initial=20, min_limit=1, max_limit=200, backoff=0.9, target_latency=None):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.target_latency = target_latency
+        self._value = float(initial)
+
+    def update(self, latency, inflight, target_latency):
+        target = self.target_latency if self.target_latency is not None else target_latency
+        if target is not None and latency > target:
+            self._value = max(self.min_limit, self._value * self.backoff)
+        elif inflight * 2 >= self.limit:
+            self._value = min(self.max_limit, self._value + 1.0 / max(self._value, 1.0))
+        self.limit = max(self.min_limit, int(self._value))
+
+class GradientLimit:
+    # Scales the limit by min_latency / latency: when latency drifts above the
+    # best seen, requests are queueing somewhere and the limit shrinks; the
+    # sqrt(limit) headroom lets it grow again while latency stays flat. The
+    # minimum is re-learned every probe_interval samples.
+    def __init__(self, initial=20, min_limit=1, max_limit=200, smoothing=0.2, tolerance=1.5, probe_interval=1000):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.probe_interval = probe_interval
+        self._value = float(initial)
+        self._min_latency = None
+        self._samples = 0
+
+    def update(self, latency, inflight, target_latency):
+        self._samples += 1
+        if self._samples >= self.probe_interval:
+            self._samples = 0
+            self._min_latency = None
+        if self._min_latency is None or latency < self._min_latency:
+            self._min_latency = latency
+        if latency <= 0:
+            return
+        gradient = max(0.5, min(1.0, self.tolerance * self._min_latency / latency))
+        new_value = self._value * gradient + math.sqrt(self._value)
+        self._value = (1 - self.smoothing) * self._value + self.smoothing * new_value
+        self._value = max(self.min_limit, min(self.max_limit, self._value))
+        self.limit = int(self._value)
+
+class RouteClass:
+    # A group of routes sharing a concurrency limit. Matches on path prefix
+    # and, when methods is given, on request method. Requests over the limit
+    # wait up to max_queue_time for a slot (at most max_queue of them) and are
+    # otherwise rejected with 503.
+    def __init__(self, name, prefixes=('/',), methods=None, limit=None, priority=NORMAL, max_queue=0, max_queue_time=0.0):
+        self.name = name
+        self.prefixes = (prefixes,) if isinstance(prefixes, str) else tuple(prefixes)
+        self.methods = frozenset(method.upper() for method in methods) if methods else None
+        if limit is None or isinstance(limit, int):
+            limit = FixedLimit(limit)
+        self.limit = limit
+        self.priority = priority
+        self.max_queue = max_queue
+        self.max_queue_time = max_queue_time
+
+    def matches(self, environ):
+        if self.methods is not None and environ.get('REQUEST_METHOD', 'GET') not in self.methods:
+            return False
+        return environ.get('PATH_INFO', '/').startswith(self.prefixes)
+
+class _ClassState:
+    def __init__(self, route_class):
+        self.route_class = route_class
+        self.condition = threading.Condition()
+        self.inflight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.shed = 0
+        self.latency = 0.0
+        self.queue_wait = 0.0
+
+    def acquire(self):
+        route_class = self.route_class
+        with self.condition:
+            limit = route_class.limit.limit
+            if limit is None or self.inflight < limit:
+                self.inflight += 1
+                self.admitted += 1
+                return 0.0
+            if self.queued >= route_class.max_queue or route_class.max_queue_time <= 0:
+                self.rejected += 1
+                return None
+            self.queued += 1
+            start = time.monotonic()
+            try:
+                admitted = self.condition.wait_for(
+                    lambda: self.inflight < route_class.limit.limit, route_class.max_queue_time
+                )
+            finally:
+                self.queued -= 1
+            if not admitted:
+                self.rejected += 1
+                return None
+            self.inflight += 1
+            self.admitted += 1
+            return time.monotonic() - start
+
+    def release(self, latency, target_latency, smoothing):
+        with self.condition:
+            self.latency = latency if not self.latency else (1 - smoothing) * self.latency + smoothing * latency
+            self.route_class.limit.update(latency, self.inflight, target_latency)
+            self.inflight -= 1
+            self.condition.notify()
+
+    def snapshot(self):
+        with self.condition:
+            return {
+                'inflight': self.inflight,
+                'limit': self.route_class.limit.limit,
+                'queued': self.queued,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'shed': self.shed,
+                'latency': self.latency,
+                'queue_wait': self.queue_wait,
+            }
+
+class _Released:
+    # Wraps the response iterable so the slot is freed when the server closes
+    # it, i.e. once the body has actually been sent.
+    def __init__(self, iterable, release):
+        self.iterable = iterable
+        self._release = release
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            close = getattr(self.iterable, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._release()
+
+class AdmissionControl:
+    # Install with app.use(AdmissionControl([...])) on Emonic or EmonicRestful.
+    # LOW routes are shed once the smoothed latency (or queue wait) exceeds
+    # target_latency, NORMAL routes past twice the target; CRITICAL routes are
+    # only bounded by their own concurrency limit. While shedding, one request
+    # per probe_interval seconds is still let through so the latency estimate
+    # can recover.
+    def __init__(self, classes, target_latency=None, retry_after=1, smoothing=0.1, probe_interval=1.0):
+        self.classes = [_ClassState(route_class) for route_class in classes]
+        self.default = _ClassState(RouteClass('default'))
+        self.target_latency = target_latency
+        self.retry_after = retry_after
+        self.smoothing = smoothing
+        self.probe_interval = probe_interval
+        self.latency = 0.0
+        self._last_probe = 0.0
+
+    def __call__(self, app):
+        return AdmissionMiddleware(app, self)
+
+    def classify(self, environ):
+        for state in self.classes:
+            if state.route_class.matches(environ):
+                return state
+        return self.default
+
+    def upstream_wait(self, environ):
+        # Time spent queued in front of the worker, when a proxy sets
+        # X-Request-Start as "t=<seconds|milliseconds|microseconds>".
+        value = environ.get('HTTP_X_REQUEST_START')
+        if not value:
+            return 0.0
+        try:
+            started = float(value[2:] if value.startswith('t=') else value)
+        except ValueError:
+            return 0.0
+        while started > 1e11:
+            started /= 1000.0
+        return max(time.time() - started, 0.0)
+
+    def should_shed(self, state, wait):
+        if self.target_latency is None:
+            return False
+        priority = state.route_class.priority
+        if priority >= CRITICAL:
+            return False
+        pressure = max(self.latency, wait)
+        threshold = self.target_latency if priority <= LOW else 2 * self.target_latency
+        if pressure <= threshold:
+            return False
+        now = time.monotonic()
+        if now - self._last_probe >= self.probe_interval:
+            self._last_probe = now
+            return False
+        return True
+
+    def record(self, state, latency):
+        self.latency = latency if not self.latency else (1 - self.smoothing) * self.latency + self.smoothing * latency
+        state.release(latency, self.target_latency, self.smoothing)
+
+    def stats(self):
+        stats = {state.route_class.name: state.snapshot() for state in self.classes}
+        stats[self.default.route_class.name] = self.default.snapshot()
+        return {'latency': self.latency, 'classes': stats}
+
+    def reject(self, start_response, reason):
+        body_data, code = ErrorHandlers.handle_503(503, reason, None)
+        body = json.dumps(body_data).encode('utf-8')
+        start_response('503 Service Unavailable', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+            ('Retry-After', str(self.retry_after)),
+        ])
+        return [body]
+
+class AdmissionMiddleware:
+    def __init__(self, app, control):
+        self.app = app
+        self.control = control
+
+    def __call__(self, environ, start_response):
+        control = self.control
+        state = control.classify(environ)
+
+        upstream = control.upstream_wait(environ)
+        if control.should_shed(state, upstream):
+            with state.condition:
+                state.shed += 1
+            return control.reject(start_response, 'Server overloaded')
+
+        wait = state.acquire()
+        if wait is None:
+            return control.reject(start_response, 'Too many concurrent requests')
+        with state.condition:
+            total_wait = upstream + wait
+            state.queue_wait = total_wait if not state.queue_wait else (
+                (1 - control.smoothing) * state.queue_wait + control.smoothing * total_wait
+            )
+
+        start = time.monotonic()
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                control.record(state, time.monotonic() - start)
+
+        try:
+            response = self.app(environ, start_response)
+        except BaseException:
+            release()
+            raise
+        return _Released(response, release)
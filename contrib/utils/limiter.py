@@ -1,41 +1,189 @@
 from functools import wraps
-from datetime import datetime, timedelta
+from datetime import timedelta
+import math
 from werkzeug.wrappers import Response
+from .storage import MemoryStorage, SharedMemoryStorage, SQLiteStorage
+
+# Rate-limiting algorithms. Each keeps a short list of floats per client and
+# answers hit/remaining/reset in constant time; `now` comes from the storage's clock.
+
+class FixedWindow:
+    # state: [window_start, count]
+    def initial(self, now):
+        return [now, 0.0]
+
+    def _roll(self, state, now, period):
+        if now - state[0] >= period:
+            state[0] = now
+            state[1] = 0.0
+
+    def hit(self, state, now, limit, period, amount=1):
+        self._roll(state, now, period)
+        if state[1] + amount > limit:
+            return False
+        state[1] += amount
+        return True
+
+    def remaining(self, state, now, limit, period):
+        self._roll(state, now, period)
+        return max(int(limit - state[1]), 0)
+
+    def reset_in(self, state, now, limit, period):
+        self._roll(state, now, period)
+        return max(state[0] + period - now, 0.0) if state[1] else 0.0
+
+    def retry_in(self, state, now, limit, period):
+        self._roll(state, now, period)
+        return max(state[0] + period - now, 0.0) if state[1] + 1 > limit else 0.0
+
+class SlidingWindow:
+    # Sliding-window counter: the previous window's count weighted by how
+    # much of it still overlaps the sliding window, plus the current count.
+    # state: [window_start, current, previous]
+    def initial(self, now):
+        return [now, 0.0, 0.0]
+
+    def _estimate(self, state, now, period):
+        elapsed = now - state[0]
+        if elapsed >= 2 * period:
+            state[0] = now
+            state[1] = state[2] = 0.0
+        elif elapsed >= period:
+            state[0] += period
+            state[2] = state[1]
+            state[1] = 0.0
+        overlap = 1.0 - (now - state[0]) / period
+        return state[2] * overlap + state[1]
+
+    def hit(self, state, now, limit, period, amount=1):
+        if self._estimate(state, now, period) + amount > limit:
+            return False
+        state[1] += amount
+        return True
+
+    def remaining(self, state, now, limit, period):
+        return max(int(limit - self._estimate(state, now, period)), 0)
+
+    def reset_in(self, state, now, limit, period):
+        if not self._estimate(state, now, period):
+            return 0.0
+        return state[0] + (2 * period if state[1] else period) - now
+
+    def retry_in(self, state, now, limit, period):
+        # time until the estimate leaves room for one more hit
+        estimate = self._estimate(state, now, period)
+        if estimate + 1 <= limit:
+            return 0.0
+        allowed = limit - 1
+        if state[1] <= allowed:
+            return max(period * (1.0 - (allowed - state[1]) / state[2]) - (now - state[0]), 0.0)
+        rollover = state[0] + period - now
+        return rollover + period * (1.0 - allowed / state[1])
+
+class TokenBucket:
+    # Refills limit tokens per period, holding at most limit.
+    # state: [tokens, last_refill]; tokens < 0 means a full, unused bucket
+    def initial(self, now):
+        return [-1.0, now]
+
+    def _refill(self, state, now, limit, period):
+        if state[0] < 0:
+            state[0] = float(limit)
+        else:
+            state[0] = min(float(limit), state[0] + (now - state[1]) * limit / period)
+        state[1] = now
+
+    def hit(self, state, now, limit, period, amount=1):
+        self._refill(state, now, limit, period)
+        if state[0] < amount:
+            return False
+        state[0] -= amount
+        return True
+
+    def remaining(self, state, now, limit, period):
+        self._refill(state, now, limit, period)
+        return int(state[0])
+
+    def reset_in(self, state, now, limit, period):
+        self._refill(state, now, limit, period)
+        return (limit - state[0]) * period / limit
+
+    def retry_in(self, state, now, limit, period):
+        self._refill(state, now, limit, period)
+        return max(1 - state[0], 0.0) * period / limit
+
+class GCRA:
+    # Generic cell rate algorithm: a single theoretical arrival time.
+    # state: [tat]
+    def initial(self, now):
+        return [now]
+
+    def hit(self, state, now, limit, period, amount=1):
+        interval = period / limit
+        tat = max(state[0], now) + amount * interval
+        if tat - now > period:
+            return False
+        state[0] = tat
+        return True
+
+    def remaining(self, state, now, limit, period):
+        interval = period / limit
+        return max(int(math.floor((period - (max(state[0], now) - now)) / interval)), 0)
+
+    def reset_in(self, state, now, limit, period):
+        return max(state[0] - now, 0.0)
+
+    def retry_in(self, state, now, limit, period):
+        return max(state[0] - now - period + period / limit, 0.0)
+
+ALGORITHMS = {
+    'fixed_window': FixedWindow(),
+    'sliding_window': SlidingWindow(),
+    'token_bucket': TokenBucket(),
+    'gcra': GCRA(),
+}
 
 class Limiter:
-    def __init__(self, app=None):
+    def __init__(self, app=None, algorithm='sliding_window', max_keys=100000, idle_ttl=None, storage=None):
         self.app = app
         self.default_limit = 100
         self.default_period = 60
         self.default_error_message = 'Rate limit exceeded'
-        self.strategies = {}
-        self.cache = {}
+        self.default_algorithm = algorithm
+        # the default storage; others are registered by name with strategy()
+        # and selected per decorator with strategy=
+        self.cache = storage if storage is not None else MemoryStorage(max_keys=max_keys, idle_ttl=idle_ttl)
+        self.strategies = {'memory': self.cache}
         self.whitelisted_ips = set()
 
-    def limit(self, limit=None, period=None, error_message=None, strategy=None):
+    def _algorithm(self, algorithm):
+        name = algorithm or self.default_algorithm
+        if name not in ALGORITHMS:
+            raise ValueError(f"Unknown rate limit algorithm '{name}'.")
+        return name, ALGORITHMS[name]
+
+    def _storage(self, strategy):
+        if strategy is None:
+            return self.cache
+        if strategy not in self.strategies:
+            raise ValueError(f"Unknown rate limit strategy '{strategy}'.")
+        return self.strategies[strategy]
+
+    def limit(self, limit=None, period=None, error_message=None, strategy=None, algorithm=None):
+        name, algo = self._algorithm(algorithm)
+        storage = self._storage(strategy)
+
         def decorator(handler):
             @wraps(handler)
             def wrapped_handler(request, *args, **kwargs):
                 key = self.get_key(request)
-                now = datetime.now()
 
                 limit_value = limit(request) if callable(limit) else (limit if limit is not None else self.default_limit)
                 period_value = period(request) if callable(period) else (period if period is not None else self.default_period)
 
-                if key in self.cache:
-                    requests = self.cache[key]
-                    valid_requests = [
-                        req for req in requests if (now - req) <= timedelta(seconds=period_value)
-                    ]
-
-                    if len(valid_requests) >= limit_value:
-                        message = error_message if error_message else self.default_error_message
-                        return self.error_response(message, error_code='RATE_LIMIT_EXCEEDED')
-
-                    valid_requests.append(now)
-                    self.cache[key] = valid_requests
-                else:
-                    self.cache[key] = [now]
+                if not storage.hit(key, (name, limit_value, period_value), algo, limit_value, period_value):
+                    message = error_message if error_message else self.default_error_message
+                    return self.error_response(message, error_code='RATE_LIMIT_EXCEEDED')
 
                 return handler(request, *args, **kwargs)
 
@@ -47,54 +195,61 @@ class Limiter:
         return request.remote_addr
 
     def strategy(self, name, storage):
+        # Registers right away; still usable as a decorator as before.
+        self.strategies[name] = storage
+
         def decorator(f):
-            self.strategies[name] = storage
             return f
         return decorator
 
-    def hit(self, key, amount=1):
-        now = datetime.now()
-        if key in self.cache:
-            requests = self.cache[key]
-            valid_requests = [
-                req for req in requests if (now - req) <= timedelta(seconds=self.default_period)
-            ]
-            valid_requests.extend([now] * amount)
-            self.cache[key] = valid_requests
-        else:
-            self.cache[key] = [now] * amount
-
-    def reset(self, key):
-        if key in self.cache:
-            del self.cache[key]
-
-    def reset_all(self):
-        self.cache = {}
-
-    def get_remaining_hits(self, key):
-        if key in self.cache:
-            requests = self.cache[key]
-            valid_requests = [
-                req for req in requests if (datetime.now() - req) <= timedelta(seconds=self.default_period)
-            ]
-            return self.default_limit - len(valid_requests)
-        return self.default_limit
-
-    def get_time_until_reset(self, key):
-        if key in self.cache:
-            requests = self.cache[key]
-            latest_request_time = max(requests)
-            reset_time = latest_request_time + timedelta(seconds=self.default_period)
-            time_until_reset = reset_time - datetime.now()
-            return max(time_until_reset, timedelta(seconds=0))
-        return timedelta(seconds=0)
-
-    def burst_limit(self, burst_limit=None, burst_period=None, error_message=None):
+    def shared_memory(self, path, name='shared', **kwargs):
+        storage = SharedMemoryStorage(path, **kwargs)
+        self.strategies[name] = storage
+        return storage
+
+    def sqlite(self, path, name='sqlite'):
+        storage = SQLiteStorage(path)
+        self.strategies[name] = storage
+        return storage
+
+    def hit(self, key, amount=1, algorithm=None, strategy=None):
+        name, algo = self._algorithm(algorithm)
+        bucket = (name, self.default_limit, self.default_period)
+        return self._storage(strategy).hit(key, bucket, algo, self.default_limit, self.default_period, amount)
+
+    def hit_many(self, keys, amount=1, algorithm=None, strategy=None):
+        # One batched storage update (one lock or transaction) for many keys.
+        name, algo = self._algorithm(algorithm)
+        bucket = (name, self.default_limit, self.default_period)
+        return self._storage(strategy).hit_many(
+            (key, bucket, algo, self.default_limit, self.default_period, amount) for key in keys
+        )
+
+    def reset(self, key, strategy=None):
+        self._storage(strategy).reset(key)
+
+    def reset_all(self, strategy=None):
+        self._storage(strategy).clear()
+
+    def get_remaining_hits(self, key, algorithm=None, strategy=None):
+        name, algo = self._algorithm(algorithm)
+        bucket = (name, self.default_limit, self.default_period)
+        return self._storage(strategy).remaining(key, bucket, algo, self.default_limit, self.default_period)
+
+    def get_time_until_reset(self, key, algorithm=None, strategy=None):
+        name, algo = self._algorithm(algorithm)
+        bucket = (name, self.default_limit, self.default_period)
+        seconds = self._storage(strategy).reset_in(key, bucket, algo, self.default_limit, self.default_period)
+        return timedelta(seconds=seconds)
+
+    def burst_limit(self, burst_limit=None, burst_period=None, error_message=None, strategy=None, algorithm=None):
+        name, algo = self._algorithm(algorithm)
+        storage = self._storage(strategy)
+
         def decorator(handler):
             @wraps(handler)
             def wrapped_handler(request, *args, **kwargs):
                 key = self.get_key(request)
-                now = datetime.now()
 
                 burst_limit_value = (
                     burst_limit(request) if callable(burst_limit) else (burst_limit if burst_limit is not None else self.default_limit)
@@ -103,15 +258,10 @@ class Limiter:
                     burst_period(request) if callable(burst_period) else (burst_period if burst_period is not None else self.default_period)
                 )
 
-                if key in self.cache:
-                    requests = self.cache[key]
-                    valid_burst_requests = [
-                        req for req in requests if (now - req) <= timedelta(seconds=burst_period_value)
-                    ]
-
-                    if len(valid_burst_requests) >= burst_limit_value:
-                        message = error_message if error_message else self.default_error_message
-                        return self.error_response(message, error_code='BURST_LIMIT_EXCEEDED')
+                bucket = (name, burst_limit_value, burst_period_value)
+                if not storage.hit(key, bucket, algo, burst_limit_value, burst_period_value):
+                    message = error_message if error_message else self.default_error_message
+                    return self.error_response(message, error_code='BURST_LIMIT_EXCEEDED')
 
                 return handler(request, *args, **kwargs)
 
@@ -119,15 +269,15 @@ class Limiter:
 
         return decorator
 
-    def rate_limit_tier(self, tier_conditions, period=None, strategy=None):
+    def rate_limit_tier(self, tier_conditions, period=None, strategy=None, algorithm=None):
         def decorator(handler):
             @wraps(handler)
             def wrapped_handler(request, *args, **kwargs):
                 for limit_condition, burst_condition, tier_limit, tier_burst in tier_conditions:
                     if limit_condition(request):
-                        return self.limit(limit=tier_limit, period=period, strategy=strategy)(handler)(request, *args, **kwargs)
+                        return self.limit(limit=tier_limit, period=period, strategy=strategy, algorithm=algorithm)(handler)(request, *args, **kwargs)
                     if burst_condition(request):
-                        return self.burst_limit(burst_limit=tier_burst, strategy=strategy)(handler)(request, *args, **kwargs)
+                        return self.burst_limit(burst_limit=tier_burst, strategy=strategy, algorithm=algorithm)(handler)(request, *args, **kwargs)
                 return handler(request, *args, **kwargs)
 
             return wrapped_handler
@@ -139,6 +289,17 @@ class Limiter:
         response.headers['X-Error-Code'] = error_code
         return response
 
+    def middleware(self, *rules, send_headers=False):
+        # Returns a factory for Emonic.use(): app.use(limiter.middleware(rule, ...)).
+        # Rules are resolved here once; Emonic rebuilds its middleware chain on
+        # every request, so the per-request object only holds references.
+        compiled = tuple((rule,) + self._algorithm(rule.algorithm) + (self._storage(rule.strategy),) for rule in rules)
+
+        def factory(app):
+            return RateLimitMiddleware(app, self, compiled, send_headers)
+
+        return factory
+
     def whitelist_ip(self, ip):
         self.whitelisted_ips.add(ip)
 
@@ -154,3 +315,79 @@ class Limiter:
             return self.error_response('Forbidden', status_code=403, error_code='FORBIDDEN')
 
         return wrapped_handler
+
+def remote_addr(environ):
+    return environ.get('REMOTE_ADDR')
+
+class RateLimitRule:
+    # Applies to requests whose path starts with prefix and, when methods is
+    # given, whose method is one of them. key_func takes the raw WSGI environ.
+    def __init__(self, limit, period, prefix='/', methods=None, key_func=None, algorithm=None, strategy=None, name=None):
+        self.limit = limit
+        self.period = period
+        self.prefix = prefix
+        self.methods = frozenset(method.upper() for method in methods) if methods else None
+        self.key_func = key_func or remote_addr
+        self.algorithm = algorithm
+        self.strategy = strategy
+        self.name = name or f"{prefix}:{','.join(sorted(self.methods)) if self.methods else '*'}"
+
+    def matches(self, environ):
+        if not environ.get('PATH_INFO', '/').startswith(self.prefix):
+            return False
+        return self.methods is None or environ.get('REQUEST_METHOD', 'GET') in self.methods
+
+class RateLimitMiddleware:
+    # Rejects over-limit requests straight from the environ, before the app
+    # builds a Request, loads the session or matches a URL.
+    def __init__(self, app, limiter, rules, send_headers=False):
+        self.app = app
+        self.limiter = limiter
+        self.rules = rules
+        self.send_headers = send_headers
+
+    def __call__(self, environ, start_response):
+        passed = None
+        for rule, name, algo, storage in self.rules:
+            if not rule.matches(environ):
+                continue
+            key = rule.key_func(environ)
+            if key in self.limiter.whitelisted_ips:
+                continue
+            bucket = (name, rule.limit, rule.period, rule.name)
+            if not storage.hit(key, bucket, algo, rule.limit, rule.period):
+                return self.reject(environ, start_response, rule, key, bucket, algo, storage)
+            if passed is None:
+                passed = (rule, key, bucket, algo, storage)
+
+        if passed is None or not self.send_headers:
+            return self.app(environ, start_response)
+
+        rule, key, bucket, algo, storage = passed
+        headers = self.rate_headers(rule, key, bucket, algo, storage)
+
+        def limited_start_response(status, response_headers, exc_info=None):
+            response_headers.extend(headers)
+            return start_response(status, response_headers, exc_info)
+
+        return self.app(environ, limited_start_response)
+
+    def rate_headers(self, rule, key, bucket, algo, storage):
+        return [
+            ('X-RateLimit-Limit', str(rule.limit)),
+            ('X-RateLimit-Remaining', str(storage.remaining(key, bucket, algo, rule.limit, rule.period))),
+            ('X-RateLimit-Reset', str(math.ceil(storage.reset_in(key, bucket, algo, rule.limit, rule.period)))),
+        ]
+
+    def reject(self, environ, start_response, rule, key, bucket, algo, storage):
+        body = self.limiter.default_error_message.encode('utf-8')
+        retry_after = math.ceil(storage.retry_in(key, bucket, algo, rule.limit, rule.period))
+        headers = [
+            ('Content-Type', 'text/plain; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+            ('Retry-After', str(max(retry_after, 1))),
+            ('X-Error-Code', 'RATE_LIMIT_EXCEEDED'),
+        ]
+        headers.extend(self.rate_headers(rule, key, bucket, algo, storage))
+        start_response('429 Too Many Requests', headers)
+        return [body]
@@ -0,0 +1,331 @@
+import hashlib
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from ..shared_files import SharedFile, SQLiteConnections
+
+# Limiter storages. A storage owns per-client algorithm state and applies a
+# hit as one atomic read-modify-write; `bucket` is (algorithm, limit, period)
+# and `algo` is one of limiter.ALGORITHMS.
+
+class MemoryStorage:
+    # Per-client limiter state for one process. Keys are spread over
+    # lock-striped LRU maps so concurrent requests for different clients
+    # rarely contend, and the read-modify-write of a hit happens under the
+    # client's stripe lock. A client record is [expires_at, {bucket: state}];
+    # it is dropped once idle for two periods of its longest bucket (its
+    # state is back to initial by then) or, when the store is full, in
+    # least-recently-used order.
+    def __init__(self, max_keys=100000, stripes=16, idle_ttl=None):
+        self.max_keys = max_keys
+        self.idle_ttl = idle_ttl
+        self._stripes = [(threading.Lock(), OrderedDict()) for _ in range(stripes)]
+        self._stripe_max = max(1, max_keys // stripes) if max_keys else None
+        self.evictions = 0
+        self.clock = time.monotonic
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def _evict(self, records, now):
+        # make room for one new record
+        while records:
+            oldest_key, oldest = next(iter(records.items()))
+            if oldest[0] <= now:
+                del records[oldest_key]
+            elif self._stripe_max is not None and len(records) >= self._stripe_max:
+                del records[oldest_key]
+                self.evictions += 1
+            else:
+                break
+
+    def _record(self, records, key, now):
+        record = records.pop(key, None)
+        if record is None or record[0] <= now:
+            self._evict(records, now)
+            record = [now, {}]
+        records[key] = record
+        return record
+
+    def _touch(self, record, now, period):
+        expires = now + (self.idle_ttl if self.idle_ttl is not None else 2 * period)
+        if expires > record[0]:
+            record[0] = expires
+
+    def hit(self, key, bucket, algo, limit, period, amount=1):
+        now = self.clock()
+        lock, records = self._stripe(key)
+        with lock:
+            record = self._record(records, key, now)
+            state = record[1].get(bucket)
+            if state is None:
+                state = record[1][bucket] = algo.initial(now)
+            allowed = algo.hit(state, now, limit, period, amount)
+            self._touch(record, now, period)
+            return allowed
+
+    def hit_many(self, hits):
+        # hits: iterable of (key, bucket, algo, limit, period, amount)
+        return [self.hit(*item) for item in hits]
+
+    def _query(self, key, bucket, algo, limit, period, method, default):
+        now = self.clock()
+        lock, records = self._stripe(key)
+        with lock:
+            record = records.get(key)
+            if record is None or record[0] <= now:
+                return default
+            state = record[1].get(bucket)
+            if state is None:
+                return default
+            return getattr(algo, method)(state, now, limit, period)
+
+    def remaining(self, key, bucket, algo, limit, period):
+        return self._query(key, bucket, algo, limit, period, 'remaining', limit)
+
+    def reset_in(self, key, bucket, algo, limit, period):
+        return self._query(key, bucket, algo, limit, period, 'reset_in', 0.0)
+
+    def retry_in(self, key, bucket, algo, limit, period):
+        return self._query(key, bucket, algo, limit, period, 'retry_in', 0.0)
+
+    def reset(self, key):
+        lock, records = self._stripe(key)
+        with lock:
+            records.pop(key, None)
+
+    def clear(self):
+        for lock, records in self._stripes:
+            with lock:
+                records.clear()
+
+    def __len__(self):
+        return sum(len(records) for _, records in self._stripes)
+
+class SharedMemoryStorage:
+    # Fixed-size counter table in a memory-mapped file shared by every worker
+    # process on the host; hits are serialized with flock. Each slot holds the
+    # client and bucket digests, an expiry and up to three state floats.
+    # Uses wall-clock time like SQLiteStorage: the monotonic clock restarts
+    # at boot, and state left in the file would then look live for up to
+    # the previous uptime.
+    _MAGIC = b'EMLIMIT1'
+    _HEADER = struct.Struct('<8sI')
+    _SLOT = struct.Struct('<B8s8sdddd')
+    _EMPTY, _USED, _DELETED = 0, 1, 2
+
+    def __init__(self, path, slots=65536, max_probes=16):
+        self.path = path
+        self.max_probes = max_probes
+        self.clock = time.time
+        self.evictions = 0
+
+        self._shared = SharedFile(path)
+        file = self._shared.file
+        with self._shared.lock():
+            file.seek(0, os.SEEK_END)
+            if file.tell() < self._HEADER.size:
+                file.seek(0)
+                file.write(self._HEADER.pack(self._MAGIC, slots))
+                file.truncate(self._HEADER.size + slots * self._SLOT.size)
+                file.flush()
+            file.seek(0)
+            magic, self.slots = self._HEADER.unpack(file.read(self._HEADER.size))
+            if magic != self._MAGIC:
+                raise ValueError(f"'{path}' is not an Emonic limiter file.")
+        self._shared.map(self._HEADER.size + self.slots * self._SLOT.size)
+
+    def _file_lock(self):
+        return self._shared.lock()
+
+    @property
+    def _map(self):
+        # reopened in forked workers, so always looked up through _shared
+        return self._shared.mmap
+
+    def _digest(self, value):
+        return hashlib.blake2b(repr(value).encode(), digest_size=8).digest()
+
+    def _offset(self, index):
+        return self._HEADER.size + index * self._SLOT.size
+
+    def _probe(self, client, bucket):
+        start = int.from_bytes(client, 'little') ^ int.from_bytes(bucket, 'little')
+        for i in range(min(self.max_probes, self.slots)):
+            yield (start + i) % self.slots
+
+    def _find(self, client, bucket, now, claim):
+        free = None
+        for index in self._probe(client, bucket):
+            state, slot_client, slot_bucket, expires, *values = self._SLOT.unpack_from(self._map, self._offset(index))
+            if state == self._USED and slot_client == client and slot_bucket == bucket:
+                if expires > now:
+                    return index, values
+                return index, None
+            if free is None and (state != self._USED or expires <= now):
+                free = index
+            if state == self._EMPTY:
+                break
+        if not claim:
+            return None, None
+        if free is None:
+            free = next(self._probe(client, bucket))
+            self.evictions += 1
+        return free, None
+
+    def _hit(self, key, bucket, algo, limit, period, amount, now):
+        client, bucket_digest = self._digest(key), self._digest(bucket)
+        index, state = self._find(client, bucket_digest, now, claim=True)
+        if state is None:
+            state = algo.initial(now)
+        allowed = algo.hit(state, now, limit, period, amount)
+        values = (list(state) + [0.0, 0.0, 0.0])[:3]
+        self._SLOT.pack_into(self._map, self._offset(index), self._USED, client, bucket_digest, now + 2 * period, *values)
+        return allowed
+
+    def hit(self, key, bucket, algo, limit, period, amount=1):
+        with self._file_lock():
+            return self._hit(key, bucket, algo, limit, period, amount, self.clock())
+
+    def hit_many(self, hits):
+        with self._file_lock():
+            now = self.clock()
+            return [self._hit(key, bucket, algo, limit, period, amount, now)
+                    for key, bucket, algo, limit, period, amount in hits]
+
+    def _query(self, key, bucket, algo, limit, period, method, default):
+        with self._file_lock():
+            now = self.clock()
+            _, state = self._find(self._digest(key), self._digest(bucket), now, claim=False)
+        if state is None:
+            return default
+        return getattr(algo, method)(state, now, limit, period)
+
+    def remaining(self, key, bucket, algo, limit, period):
+        return self._query(key, bucket, algo, limit, period, 'remaining', limit)
+
+    def reset_in(self, key, bucket, algo, limit, period):
+        return self._query(key, bucket, algo, limit, period, 'reset_in', 0.0)
+
+    def retry_in(self, key, bucket, algo, limit, period):
+        return self._query(key, bucket, algo, limit, period, 'retry_in', 0.0)
+
+    def reset(self, key):
+        # A client's buckets are spread over the table, so this is a full scan.
+        client = self._digest(key)
+        with self._file_lock():
+            for index in range(self.slots):
+                offset = self._offset(index)
+                state, slot_client = self._SLOT.unpack_from(self._map, offset)[:2]
+                if state == self._USED and slot_client == client:
+                    self._SLOT.pack_into(self._map, offset, self._DELETED, b'', b'', 0.0, 0.0, 0.0, 0.0)
+
+    def clear(self):
+        with self._file_lock():
+            self._map[self._HEADER.size:] = bytes(self.slots * self._SLOT.size)
+
+    def __len__(self):
+        now = self.clock()
+        count = 0
+        with self._file_lock():
+            for index in range(self.slots):
+                state, _, _, expires = self._SLOT.unpack_from(self._map, self._offset(index))[:4]
+                if state == self._USED and expires > now:
+                    count += 1
+        return count
+
+    def close(self):
+        self._shared.close()
+
+class SQLiteStorage:
+    # Limiter state in an SQLite file; each hit (or batch of hits) is one
+    # IMMEDIATE transaction, so concurrent workers count atomically. Uses
+    # wall-clock time so state survives restarts.
+    def __init__(self, path):
+        self.path = path
+        self.clock = time.time
+        self._connections = SQLiteConnections(path)
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS emonic_limiter ('
+            'client TEXT NOT NULL, bucket TEXT NOT NULL, expires REAL NOT NULL, '
+            'v0 REAL, v1 REAL, v2 REAL, PRIMARY KEY (client, bucket))'
+        )
+
+    def _connection(self):
+        return self._connections.get()
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _load(self, conn, key, bucket, now):
+        row = conn.execute(
+            'SELECT expires, v0, v1, v2 FROM emonic_limiter WHERE client = ? AND bucket = ?',
+            (str(key), repr(bucket))
+        ).fetchone()
+        if row is None or row[0] <= now:
+            return None
+        return list(row[1:])
+
+    def _hit(self, conn, key, bucket, algo, limit, period, amount, now):
+        state = self._load(conn, key, bucket, now)
+        if state is None:
+            state = algo.initial(now)
+        allowed = algo.hit(state, now, limit, period, amount)
+        values = (list(state) + [0.0, 0.0, 0.0])[:3]
+        conn.execute(
+            'INSERT OR REPLACE INTO emonic_limiter (client, bucket, expires, v0, v1, v2) VALUES (?, ?, ?, ?, ?, ?)',
+            (str(key), repr(bucket), now + 2 * period, *values)
+        )
+        return allowed
+
+    def hit(self, key, bucket, algo, limit, period, amount=1):
+        with self._transaction() as conn:
+            return self._hit(conn, key, bucket, algo, limit, period, amount, self.clock())
+
+    def hit_many(self, hits):
+        with self._transaction() as conn:
+            now = self.clock()
+            return [self._hit(conn, key, bucket, algo, limit, period, amount, now)
+                    for key, bucket, algo, limit, period, amount in hits]
+
+    def _query(self, key, bucket, algo, limit, period, method, default):
+        now = self.clock()
+        state = self._load(self._connection(), key, bucket, now)
+        if state is None:
+            return default
+        return getattr(algo, method)(state, now, limit, period)
+
+    def remaining(self, key, bucket, algo, limit, period):
+        return self._query(key, bucket, algo, limit, period, 'remaining', limit)
+
+    def reset_in(self, key, bucket, algo, limit, period):
+        return self._query(key, bucket, algo, limit, period, 'reset_in', 0.0)
+
+    def retry_in(self, key, bucket, algo, limit, period):
+        return self._query(key, bucket, algo, limit, period, 'retry_in', 0.0)
+
+    def reset(self, key):
+        self._connection().execute('DELETE FROM emonic_limiter WHERE client = ?', (str(key),))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM emonic_limiter')
+
+    def purge_expired(self):
+        cursor = self._connection().execute('DELETE FROM emonic_limiter WHERE expires <= ?', (self.clock(),))
+        return cursor.rowcount
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM emonic_limiter WHERE expires > ?', (self.clock(),)
+        ).fetchone()[0]
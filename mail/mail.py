@@ -7,8 +7,547 @@ import ssl
 import importlib
 import sys
 import logging
+import hashlib
+import heapq
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
 from typing import List
 
+class _PooledConnection:
+    __slots__ = ('server', 'created', 'last_used', 'messages')
+
+    def __init__(self, server):
+        self.server = server
+        self.created = self.last_used = time.monotonic()
+        self.messages = 0
+
+class SMTPConnectionPool:
+    # Keeps up to max_connections authenticated SMTP sessions open for one
+    # MAILER config. A connection idle for longer than health_check_interval
+    # is probed with NOOP before reuse, one idle past idle_timeout is closed,
+    # and each is retired after max_messages messages. smtp_factory defaults
+    # to smtplib.SMTP and can be swapped for a local stand-in.
+    def __init__(self, config, max_connections=4, max_messages=100, idle_timeout=60,
+                 health_check_interval=30, timeout=None, smtp_factory=None):
+        self.config = config
+        self.max_connections = max_connections
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self.smtp_factory = smtp_factory or smtplib.SMTP
+        self._idle = []
+        self._open = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def _connect(self, timeout=None):
+        config = self.config
+        timeout = timeout if timeout is not None else self.timeout
+        if timeout is None:
+            server = self.smtp_factory(config['SMTP'], config['PORT'])
+        else:
+            server = self.smtp_factory(config['SMTP'], config['PORT'], timeout=timeout)
+        try:
+            if config.get('SSL'):
+                server.starttls(context=ssl.create_default_context())
+            if config.get('USERNAME'):
+                server.login(config['USERNAME'], config['PASSWORD'])
+        except BaseException:
+            self._quit(server)
+            raise
+        self.created += 1
+        return _PooledConnection(server)
+
+    @staticmethod
+    def _quit(server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _healthy(self, connection, now):
+        if now - connection.last_used > self.idle_timeout:
+            return False
+        if now - connection.last_used <= self.health_check_interval:
+            return True
+        try:
+            return connection.server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def acquire(self, timeout=None, fresh=False):
+        # Waits up to timeout seconds (forever when None) for a free slot.
+        # fresh=True always opens a new connection, closing an idle one if
+        # the pool is full.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        stale = None
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("SMTP connection pool is closed")
+                if self._idle and not fresh:
+                    connection = self._idle.pop()
+                    break
+                if self._open < self.max_connections:
+                    self._open += 1
+                    connection = None
+                    break
+                if self._idle:
+                    stale = self._idle.pop()
+                    connection = None
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("No SMTP connection available")
+                self._condition.wait(remaining)
+        if stale is not None:
+            self.discarded += 1
+            self._quit(stale.server)
+        try:
+            if connection is not None:
+                if self._healthy(connection, time.monotonic()):
+                    self.reused += 1
+                    return connection
+                self.discarded += 1
+                self._quit(connection.server)
+            return self._connect(timeout)
+        except BaseException:
+            self._forget()
+            raise
+
+    def _forget(self):
+        with self._condition:
+            self._open -= 1
+            self._condition.notify()
+
+    def release(self, connection, broken=False):
+        connection.last_used = time.monotonic()
+        if broken or self._closed or connection.messages >= self.max_messages:
+            if broken:
+                self.discarded += 1
+            self._quit(connection.server)
+            self._forget()
+            return
+        with self._condition:
+            self._idle.append(connection)
+            self._condition.notify()
+
+    def _discard_idle(self):
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self.discarded += len(idle)
+            self._condition.notify_all()
+        for connection in idle:
+            self._quit(connection.server)
+
+    @contextmanager
+    def connection(self, timeout=None, fresh=False):
+        connection = self.acquire(timeout, fresh)
+        server = connection.server
+        if server.sock is not None:
+            # a reused connection keeps the timeout it was opened with
+            server.sock.settimeout(self.timeout if timeout is None else timeout)
+        try:
+            yield server
+        except smtplib.SMTPServerDisconnected:
+            self.release(connection, broken=True)
+            raise
+        except smtplib.SMTPException:
+            # SMTPException subclasses OSError, but a refused recipient or
+            # sender leaves the session usable
+            self.release(connection)
+            raise
+        except OSError:
+            self.release(connection, broken=True)
+            raise
+        except BaseException:
+            self.release(connection)
+            raise
+        connection.messages += 1
+        self.release(connection)
+
+    def send(self, from_addr, to_addrs, message, timeout=None):
+        # A connection the server dropped since its last use only shows up
+        # when sending. The other idle ones most likely went with it (e.g.
+        # a server restart), so they are all dropped and the message is
+        # retried once on a newly opened connection.
+        for attempt in (0, 1):
+            try:
+                with self.connection(timeout, fresh=bool(attempt)) as server:
+                    return server.sendmail(from_addr, to_addrs, message)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                if attempt:
+                    raise
+                self._discard_idle()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._condition.notify_all()
+        for connection in idle:
+            self._quit(connection.server)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'open': self._open,
+                'idle': len(self._idle),
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+            }
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_connection_pool(config, **options):
+    # One pool per MAILER config and process; a forked worker must not share
+    # the parent's sockets. POOL_SIZE and POOL_MAX_MESSAGES in the config
+    # override the defaults.
+    key = (os.getpid(), config.get('NAME'), config['SMTP'], config['PORT'], config.get('USERNAME'))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            if 'POOL_SIZE' in config:
+                options.setdefault('max_connections', config['POOL_SIZE'])
+            if 'POOL_MAX_MESSAGES' in config:
+                options.setdefault('max_messages', config['POOL_MAX_MESSAGES'])
+            pool = _pools[key] = SMTPConnectionPool(config, **options)
+        return pool
+
+def close_connection_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+def _permanent_failure(error):
+    # 5xx replies will not change on retry; everything else (4xx, dropped
+    # connections, timeouts) is worth another attempt.
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+class MailQueue:
+    # Outbox drained by a fixed set of daemon worker threads calling
+    # send(from_addr, to_addrs, message). Failed messages are retried after
+    # backoff * 2 ** (attempts - 1) seconds (jittered, capped at max_backoff)
+    # and dead-lettered after max_attempts or a permanent 5xx reply.
+    #
+    # With spool_dir, every message is written to <id>.<pid>.msg before
+    # put() returns and removed once sent, so delivery is at least once
+    # across crashes. On start, messages left by processes that are no longer
+    # running are claimed by renaming them to this pid; dead letters are moved
+    # to spool_dir/dead.
+    _SUFFIX = '.msg'
+
+    def __init__(self, send, spool_dir=None, workers=2, max_size=10000, max_attempts=5,
+                 backoff=1.0, max_backoff=300.0, smoothing=0.1, logger=None):
+        self.send = send
+        # '' (an unset setting) means no spool, not the working directory
+        self.spool_dir = spool_dir or None
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.smoothing = smoothing
+        self.logger = logger or logging.getLogger(__name__)
+        self._heap = []
+        self._sequence = 0
+        self._inflight = 0
+        self._condition = threading.Condition()
+        self._closing = False
+        self._dead = deque(maxlen=1000)
+        self.enqueued = 0
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+        self.latency = 0.0
+        self.send_time = 0.0
+        if self.spool_dir is not None:
+            os.makedirs(os.path.join(self.spool_dir, 'dead'), exist_ok=True)
+            self._claim_spool()
+            self._recover()
+        self._workers = [
+            threading.Thread(target=self._work, name=f'mail-queue-{i}', daemon=True) for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _claim_spool(self):
+        # Two live queues in one process would take each other's messages
+        # for leftovers of a dead process, and send them twice.
+        spool = os.path.realpath(self.spool_dir)
+        with _spools_lock:
+            if spool in _spools:
+                raise ValueError(f"Spool directory '{self.spool_dir}' is already used by another mail queue.")
+            _spools.add(spool)
+
+    def _path(self, item, pid=None):
+        return os.path.join(self.spool_dir, f"{item['id']}.{pid or os.getpid()}{self._SUFFIX}")
+
+    def _write(self, path, item):
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(item, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def _running(pid):
+        if pid == os.getpid():
+            return False  # our own pid, reused after a restart
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _owner(self, name):
+        # (id, pid) of '<id>.<pid>.msg' or its '.tmp'; None for other files
+        stem = name[:-4] if name.endswith('.tmp') else name
+        if not stem.endswith(self._SUFFIX):
+            return None
+        parts = stem[:-len(self._SUFFIX)].split('.')
+        if len(parts) != 2 or not parts[1].isdigit():
+            return None
+        return parts[0], int(parts[1])
+
+    def _recover(self):
+        # Files with this process's pid can only be left over from an earlier
+        # process that had the same pid: no other live queue in this process
+        # uses the directory (see _claim_spool).
+        recovered = []
+        for name in os.listdir(self.spool_dir):
+            owner = self._owner(name)
+            if owner is None:
+                continue
+            message_id, pid = owner
+            if self._running(pid):
+                continue
+            if name.endswith('.tmp'):
+                # a write that never completed; the message was not acknowledged
+                os.unlink(os.path.join(self.spool_dir, name))
+                continue
+            path = os.path.join(self.spool_dir, name)
+            claimed = self._path({'id': message_id})
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue  # claimed by another process first
+            with open(claimed, encoding='utf-8') as f:
+                recovered.append(json.load(f))
+        recovered.sort(key=lambda item: item['enqueued'])
+        with self._condition:
+            for item in recovered:
+                self._schedule(item)
+        if recovered:
+            self.logger.info(f"Recovered {len(recovered)} spooled email(s).")
+
+    def _schedule(self, item):
+        self._sequence += 1
+        heapq.heappush(self._heap, (item['next_attempt'], self._sequence, item))
+        self._condition.notify()
+
+    def put(self, from_addr, to_addrs, message):
+        # Returns the message id once it is queued (and spooled); raises
+        # queue.Full when max_size messages are already waiting.
+        now = time.time()
+        item = {
+            'id': uuid.uuid4().hex, 'from': from_addr, 'to': to_addrs, 'message': message,
+            'attempts': 0, 'enqueued': now, 'next_attempt': now, 'error': None,
+        }
+        if len(self) >= self.max_size:
+            raise queue.Full("Mail queue is full")
+        # fsync outside the lock so concurrent producers do not serialize on it
+        if self.spool_dir is not None:
+            self._write(self._path(item), item)
+        with self._condition:
+            if self._closing:
+                raise RuntimeError("Mail queue is closed")
+            self.enqueued += 1
+            self._schedule(item)
+        return item['id']
+
+    def _next(self):
+        with self._condition:
+            while not self._closing:
+                if self._heap:
+                    wait = self._heap[0][0] - time.time()
+                    if wait <= 0:
+                        self._inflight += 1
+                        return heapq.heappop(self._heap)[2]
+                else:
+                    wait = None
+                self._condition.wait(wait)
+            return None
+
+    def _work(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            start = time.monotonic()
+            try:
+                self.send(item['from'], item['to'], item['message'])
+            except Exception as e:
+                self._failed(item, e)
+            else:
+                self._delivered(item, time.monotonic() - start)
+
+    def _smooth(self, average, sample):
+        return sample if not average else (1 - self.smoothing) * average + self.smoothing * sample
+
+    def _delivered(self, item, send_time):
+        if self.spool_dir is not None:
+            try:
+                os.unlink(self._path(item))
+            except FileNotFoundError:
+                pass
+        with self._condition:
+            self._inflight -= 1
+            self.sent += 1
+            self.send_time = self._smooth(self.send_time, send_time)
+            self.latency = self._smooth(self.latency, time.time() - item['enqueued'])
+            self._condition.notify_all()
+
+    def _failed(self, item, error):
+        item['attempts'] += 1
+        item['error'] = f'{type(error).__name__}: {error}'
+        if item['attempts'] >= self.max_attempts or _permanent_failure(error):
+            self._dead_letter(item)
+            return
+        delay = min(self.max_backoff, self.backoff * 2 ** (item['attempts'] - 1))
+        item['next_attempt'] = time.time() + delay * random.uniform(0.5, 1.0)
+        if self.spool_dir is not None:
+            self._write(self._path(item), item)
+        self.logger.warning(f"Email {item['id']} failed (attempt {item['attempts']}), retrying: {item['error']}")
+        with self._condition:
+            self._inflight -= 1
+            self.retried += 1
+            self._schedule(item)
+
+    def _dead_letter(self, item):
+        if self.spool_dir is not None:
+            path = os.path.join(self.spool_dir, 'dead', item['id'] + self._SUFFIX)
+            self._write(path, item)
+            os.unlink(self._path(item))
+        self.logger.error(f"Email {item['id']} dead-lettered after {item['attempts']} attempt(s): {item['error']}")
+        with self._condition:
+            self._inflight -= 1
+            self.dead += 1
+            self._dead.append(item)
+            self._condition.notify_all()
+
+    def dead_letters(self):
+        if self.spool_dir is None:
+            return list(self._dead)
+        dead_dir = os.path.join(self.spool_dir, 'dead')
+        items = []
+        for name in sorted(os.listdir(dead_dir)):
+            if name.endswith(self._SUFFIX):
+                with open(os.path.join(dead_dir, name), encoding='utf-8') as f:
+                    items.append(json.load(f))
+        return items
+
+    def join(self, timeout=None):
+        # Waits until nothing is queued or being sent; False on timeout.
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._heap and not self._inflight, timeout)
+
+    def __len__(self):
+        return len(self._heap) + self._inflight
+
+    def stats(self):
+        with self._condition:
+            oldest = min((item['enqueued'] for _, _, item in self._heap), default=None)
+            return {
+                'depth': len(self._heap) + self._inflight,
+                'inflight': self._inflight,
+                'enqueued': self.enqueued,
+                'sent': self.sent,
+                'retried': self.retried,
+                'dead': self.dead,
+                'latency': self.latency,
+                'send_time': self.send_time,
+                'oldest_age': time.time() - oldest if oldest is not None else 0.0,
+            }
+
+    def close(self, timeout=None):
+        # Stops the workers after their current message; anything still
+        # queued stays in the spool for the next start.
+        with self._condition:
+            if self._closing:
+                return
+            self._closing = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
+        if self.spool_dir is not None:
+            with _spools_lock:
+                _spools.discard(os.path.realpath(self.spool_dir))
+
+_queues = {}
+_queues_lock = threading.Lock()
+_spools = set()
+_spools_lock = threading.Lock()
+
+def _spool_name(config):
+    if config.get('NAME'):
+        return re.sub(r'[^\w.-]', '_', config['NAME'])
+    account = f"{config['SMTP']}:{config['PORT']}:{config.get('USERNAME')}"
+    return hashlib.sha256(account.encode('utf-8')).hexdigest()[:16]
+
+def get_mail_queue(config, **options):
+    # One queue per MAILER config and process; worker threads do not survive
+    # a fork. QUEUE_WORKERS, QUEUE_SPOOL_DIR, QUEUE_MAX_SIZE and
+    # QUEUE_MAX_ATTEMPTS in the config override the defaults. Each config
+    # spools into its own subdirectory of QUEUE_SPOOL_DIR, so a recovered
+    # message is always sent through the account it was queued for.
+    key = (os.getpid(), config.get('NAME'), config['SMTP'], config['PORT'], config.get('USERNAME'))
+    with _queues_lock:
+        mail_queue = _queues.get(key)
+        if mail_queue is None:
+            for name, option in (('QUEUE_WORKERS', 'workers'), ('QUEUE_MAX_SIZE', 'max_size'),
+                                 ('QUEUE_MAX_ATTEMPTS', 'max_attempts')):
+                if name in config:
+                    options.setdefault(option, config[name])
+            if config.get('QUEUE_SPOOL_DIR'):
+                options.setdefault('spool_dir', os.path.join(config['QUEUE_SPOOL_DIR'], _spool_name(config)))
+            mail_queue = _queues[key] = MailQueue(get_connection_pool(config).send, **options)
+        return mail_queue
+
+def close_mail_queues(timeout=None):
+    with _queues_lock:
+        queues = list(_queues.values())
+        _queues.clear()
+    for mail_queue in queues:
+        mail_queue.close(timeout)
+
 class Mailer:
     def __init__(self, config_name=None):
         self.logger = logging.getLogger(__name__)
@@ -34,25 +573,27 @@ class Mailer:
             self.logger.error("No settings.py found.")
             sys.exit(1)
 
+    @property
+    def pool(self):
+        return get_connection_pool(self.config)
+
     def _send_email(self, message, timeout=None):
-        context = ssl.create_default_context() if self.config['SSL'] else None
-        
         try:
-            with smtplib.SMTP(self.config['SMTP'], self.config['PORT'], timeout=timeout) as server:
-                if self.config['SSL']:
-                    server.starttls(context=context)
-                server.login(self.config['USERNAME'], self.config['PASSWORD'])
-                server.sendmail(message['From'], message['To'], message.as_string())
+            self.pool.send(message['From'], message['To'], message.as_string(), timeout=timeout)
             return True
         except Exception as e:
             self.logger.error("Error sending email:", exc_info=True)
             return False
 
-    def send_email(self, to_email, subject, body=None, html_body=None, from_email=None, cc=None, bcc=None,
-                   reply_to=None, attachments=None, inline_images=None, headers=None, charset='utf-8', timeout=None):
+    @property
+    def queue(self):
+        return get_mail_queue(self.config)
+
+    def _build_message(self, to_email, subject, body=None, html_body=None, from_email=None, cc=None, bcc=None,
+                       reply_to=None, attachments=None, inline_images=None, headers=None, charset='utf-8'):
         if not body and not html_body:
             self.logger.error("Both 'body' and 'html_body' cannot be None.")
-            return
+            return None
 
         if not from_email:
             from_email = self.config['DEFAULT_SENDER']
@@ -93,8 +634,30 @@ class Mailer:
                     img.add_header('Content-Disposition', 'inline', filename=inline_image)
                     msg.attach(img)
 
+        return msg
+
+    def send_email(self, to_email, subject, body=None, html_body=None, from_email=None, cc=None, bcc=None,
+                   reply_to=None, attachments=None, inline_images=None, headers=None, charset='utf-8', timeout=None):
+        msg = self._build_message(to_email, subject, body, html_body, from_email, cc, bcc, reply_to,
+                                  attachments, inline_images, headers, charset)
+        if msg is None:
+            return
         return self._send_email(msg, timeout=timeout)
 
+    def enqueue(self, to_email, subject, body=None, html_body=None, from_email=None, cc=None, bcc=None,
+                reply_to=None, attachments=None, inline_images=None, headers=None, charset='utf-8'):
+        # Hands the message to the background queue and returns its id
+        # without waiting for the mail server; None if it could not be queued.
+        msg = self._build_message(to_email, subject, body, html_body, from_email, cc, bcc, reply_to,
+                                  attachments, inline_images, headers, charset)
+        if msg is None:
+            return None
+        try:
+            return self.queue.put(msg['From'], msg['To'], msg.as_string())
+        except Exception:
+            self.logger.error("Error queueing email:", exc_info=True)
+            return None
+
     def send_bulk_email(self, to_emails: List[str], subject, body=None, html_body=None, from_email=None,
                         cc=None, bcc=None, reply_to=None, attachments=None, inline_images=None,
                         headers=None, charset='utf-8', timeout=None):
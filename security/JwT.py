@@ -1,23 +1,559 @@
 import base64
+import hashlib
+import hmac
 import json
 import datetime
+import os
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .revocation import RevocationStore
+from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives import hmac as hmac_primitives
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, padding
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature, encode_dss_signature
 import secrets
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
 
+_HMAC_DIGESTS = {'HS256': 'sha256', 'HS384': 'sha384', 'HS512': 'sha512'}
+_RSA_HASHES = {'RS256': hashes.SHA256, 'RS384': hashes.SHA384, 'RS512': hashes.SHA512}
+# algorithm: (hash, curve, size of r and s in bytes)
+_EC_ALGORITHMS = {
+    'ES256': (hashes.SHA256, ec.SECP256R1, 32),
+    'ES384': (hashes.SHA384, ec.SECP384R1, 48),
+    'ES512': (hashes.SHA512, ec.SECP521R1, 66),
+}
+_ASYMMETRIC_ALGORITHMS = frozenset(_RSA_HASHES) | frozenset(_EC_ALGORITHMS) | {'EdDSA'}
+
+def _b64encode_signature(signature):
+    # padded, as JwT has always emitted signatures
+    return base64.urlsafe_b64encode(signature).decode('utf-8')
+
+_B64_STANDARD = str.maketrans('-_', '+/')
+
+def _b64decode_signature(signature):
+    # Strict: only the exact encoding JwT emits (padded or not) is accepted,
+    # so extra or altered characters cannot ride along on a valid signature.
+    stripped = signature.rstrip('=')
+    decoded = base64.b64decode((stripped + '=' * (-len(stripped) % 4)).translate(_B64_STANDARD), validate=True)
+    encoded = _b64encode_signature(decoded)
+    if signature != encoded and signature != encoded.rstrip('='):
+        raise ValueError("Invalid signature encoding")
+    return decoded
+
+def _load_private_key(key):
+    if isinstance(key, (str, bytes)):
+        return serialization.load_pem_private_key(key.encode('utf-8') if isinstance(key, str) else key, password=None)
+    return key
+
+def _load_public_key(key):
+    if isinstance(key, (str, bytes)):
+        return serialization.load_pem_public_key(key.encode('utf-8') if isinstance(key, str) else key)
+    return key
+
+def _check_key_type(algorithm, key):
+    # Refuse e.g. an EC key for RS256 instead of failing deep in cryptography.
+    if algorithm in _RSA_HASHES:
+        expected = (rsa.RSAPrivateKey, rsa.RSAPublicKey)
+    elif algorithm in _EC_ALGORITHMS:
+        expected = (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)
+    else:
+        expected = (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)
+    if not isinstance(key, expected):
+        raise ValueError(f"Key type does not match algorithm {algorithm}")
+    if algorithm in _EC_ALGORITHMS and key.curve.name != _EC_ALGORITHMS[algorithm][1].name:
+        raise ValueError(f"{algorithm} requires curve {_EC_ALGORITHMS[algorithm][1].name}")
+
+class Signer:
+    # Holds the parsed key and the hash/padding choice for one algorithm so
+    # that signing a token is only the signature itself. key is the HMAC
+    # secret for HS*, and a PEM string or private key object otherwise.
+    def __init__(self, algorithm, key):
+        self.algorithm = algorithm
+        if algorithm in _HMAC_DIGESTS:
+            if not key:
+                raise ValueError("Secret key is required for HMAC algorithm")
+            self._digest = _HMAC_DIGESTS[algorithm]
+            self._secret = key.encode('utf-8') if isinstance(key, str) else bytes(key)
+            self.key = self._secret
+            self._sign = self._sign_hmac
+            return
+        if algorithm not in _ASYMMETRIC_ALGORITHMS:
+            raise ValueError("Unsupported algorithm")
+        if not key:
+            raise ValueError(f"Private key is required for {algorithm}")
+        self.key = _load_private_key(key)
+        _check_key_type(algorithm, self.key)
+        if algorithm in _RSA_HASHES:
+            self._padding = padding.PKCS1v15()
+            self._hash = _RSA_HASHES[algorithm]()
+            self._sign = self._sign_rsa
+        elif algorithm in _EC_ALGORITHMS:
+            hash_type, _, self._size = _EC_ALGORITHMS[algorithm]
+            self._ecdsa = ec.ECDSA(hash_type())
+            self._sign = self._sign_ec
+        else:
+            self._sign = self.key.sign
+
+    def _sign_hmac(self, data):
+        return hmac.digest(self._secret, data, self._digest)
+
+    def _sign_rsa(self, data):
+        return self.key.sign(data, self._padding, self._hash)
+
+    def _sign_ec(self, data):
+        # JWS wants the fixed-width r || s form rather than DER (RFC 7518 3.4)
+        r, s = decode_dss_signature(self.key.sign(data, self._ecdsa))
+        return r.to_bytes(self._size, 'big') + s.to_bytes(self._size, 'big')
+
+    def sign(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return _b64encode_signature(self._sign(data))
+
+    def verification_key(self):
+        # the secret for HMAC, otherwise the matching public key object
+        if self.algorithm in _HMAC_DIGESTS:
+            return self.key
+        return self.key.public_key()
+
+class Verifier:
+    # Verification counterpart of Signer; key is the HMAC secret for HS*, and
+    # a PEM string or public key object otherwise.
+    def __init__(self, algorithm, key):
+        self.algorithm = algorithm
+        if algorithm in _HMAC_DIGESTS:
+            if not key:
+                raise ValueError("Secret key is required for HMAC algorithm")
+            self._signer = Signer(algorithm, key)
+            self.key = self._signer.key
+            self._verify = self._verify_hmac
+            return
+        if algorithm not in _ASYMMETRIC_ALGORITHMS:
+            raise ValueError("Unsupported algorithm")
+        if not key:
+            raise ValueError(f"Public key is required for {algorithm}")
+        self.key = _load_public_key(key)
+        _check_key_type(algorithm, self.key)
+        if algorithm in _RSA_HASHES:
+            self._padding = padding.PKCS1v15()
+            self._hash = _RSA_HASHES[algorithm]()
+            self._verify = self._verify_rsa
+        elif algorithm in _EC_ALGORITHMS:
+            hash_type, _, self._size = _EC_ALGORITHMS[algorithm]
+            self._ecdsa = ec.ECDSA(hash_type())
+            self._verify = self._verify_ec
+        else:
+            self._verify = self._verify_eddsa
+
+    def _verify_hmac(self, data, signature):
+        return hmac.compare_digest(self._signer._sign(data), signature)
+
+    def _verify_rsa(self, data, signature):
+        try:
+            self.key.verify(signature, data, self._padding, self._hash)
+            return True
+        except InvalidSignature:
+            return False
+
+    def _verify_ec(self, data, signature):
+        size = self._size
+        if len(signature) != 2 * size:
+            return False
+        der = encode_dss_signature(int.from_bytes(signature[:size], 'big'), int.from_bytes(signature[size:], 'big'))
+        try:
+            self.key.verify(der, data, self._ecdsa)
+            return True
+        except InvalidSignature:
+            return False
+
+    def _verify_eddsa(self, data, signature):
+        try:
+            self.key.verify(signature, data)
+            return True
+        except InvalidSignature:
+            return False
+
+    def verify(self, data, signature):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        try:
+            signature = _b64decode_signature(signature)
+        except (ValueError, TypeError):
+            return False
+        return self._verify(data, signature)
+
+def _b64url_uint(value):
+    return base64.urlsafe_b64encode(value.to_bytes((value.bit_length() + 7) // 8 or 1, 'big')).rstrip(b'=').decode('ascii')
+
+def _b64url_bytes(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _jwk_uint(jwk, name):
+    return int.from_bytes(_b64url_bytes(jwk[name]), 'big')
+
+# JWK crv name: (default algorithm, curve)
+_JWK_CURVES = {'P-256': ('ES256', ec.SECP256R1), 'P-384': ('ES384', ec.SECP384R1), 'P-521': ('ES512', ec.SECP521R1)}
+
+def jwk_to_keys(jwk):
+    # Returns (kid, algorithm, signing_key, verification_key); signing_key is
+    # None for public-only keys.
+    kty = jwk.get('kty')
+    if kty == 'oct':
+        secret = _b64url_bytes(jwk['k'])
+        return jwk.get('kid'), jwk.get('alg', 'HS256'), secret, secret
+    if kty == 'RSA':
+        n, e = _jwk_uint(jwk, 'n'), _jwk_uint(jwk, 'e')
+        public_numbers = rsa.RSAPublicNumbers(e, n)
+        private_key = None
+        if 'd' in jwk:
+            d = _jwk_uint(jwk, 'd')
+            if 'p' in jwk and 'q' in jwk:
+                p, q = _jwk_uint(jwk, 'p'), _jwk_uint(jwk, 'q')
+            else:
+                p, q = rsa.rsa_recover_prime_factors(n, e, d)
+            private_key = rsa.RSAPrivateNumbers(
+                p, q, d, rsa.rsa_crt_dmp1(d, p), rsa.rsa_crt_dmq1(d, q), rsa.rsa_crt_iqmp(p, q), public_numbers
+            ).private_key()
+        return jwk.get('kid'), jwk.get('alg', 'RS256'), private_key, public_numbers.public_key()
+    if kty == 'EC':
+        algorithm, curve = _JWK_CURVES[jwk['crv']]
+        public_numbers = ec.EllipticCurvePublicNumbers(_jwk_uint(jwk, 'x'), _jwk_uint(jwk, 'y'), curve())
+        private_key = None
+        if 'd' in jwk:
+            private_key = ec.EllipticCurvePrivateNumbers(_jwk_uint(jwk, 'd'), public_numbers).private_key()
+        return jwk.get('kid'), jwk.get('alg', algorithm), private_key, public_numbers.public_key()
+    if kty == 'OKP' and jwk.get('crv') == 'Ed25519':
+        private_key = None
+        if 'd' in jwk:
+            private_key = ed25519.Ed25519PrivateKey.from_private_bytes(_b64url_bytes(jwk['d']))
+        public_key = ed25519.Ed25519PublicKey.from_public_bytes(_b64url_bytes(jwk['x']))
+        return jwk.get('kid'), 'EdDSA', private_key, public_key
+    raise ValueError(f"Unsupported JWK key type '{kty}'")
+
+def keys_to_jwk(kid, algorithm, signing_key=None, verification_key=None, include_private=False):
+    if algorithm in _HMAC_DIGESTS:
+        secret = signing_key if signing_key is not None else verification_key
+        if isinstance(secret, str):
+            secret = secret.encode('utf-8')
+        jwk = {'kty': 'oct', 'k': _b64url(secret)}
+    elif algorithm in _EC_ALGORITHMS:
+        public_numbers = verification_key.public_numbers()
+        size = _EC_ALGORITHMS[algorithm][2]
+        crv = next(name for name, (alg, _) in _JWK_CURVES.items() if alg == algorithm)
+        jwk = {'kty': 'EC', 'crv': crv,
+               'x': _b64url(public_numbers.x.to_bytes(size, 'big')), 'y': _b64url(public_numbers.y.to_bytes(size, 'big'))}
+        if include_private and signing_key is not None:
+            jwk['d'] = _b64url(signing_key.private_numbers().private_value.to_bytes(size, 'big'))
+    elif algorithm == 'EdDSA':
+        raw = serialization.Encoding.Raw
+        jwk = {'kty': 'OKP', 'crv': 'Ed25519', 'x': _b64url(verification_key.public_bytes(raw, serialization.PublicFormat.Raw))}
+        if include_private and signing_key is not None:
+            jwk['d'] = _b64url(signing_key.private_bytes(raw, serialization.PrivateFormat.Raw, serialization.NoEncryption()))
+    else:
+        public_numbers = verification_key.public_numbers()
+        jwk = {'kty': 'RSA', 'n': _b64url_uint(public_numbers.n), 'e': _b64url_uint(public_numbers.e)}
+        if include_private and signing_key is not None:
+            private_numbers = signing_key.private_numbers()
+            for name, value in (('d', private_numbers.d), ('p', private_numbers.p), ('q', private_numbers.q),
+                                ('dp', private_numbers.dmp1), ('dq', private_numbers.dmq1), ('qi', private_numbers.iqmp)):
+                jwk[name] = _b64url_uint(value)
+    jwk.update({'kid': kid, 'alg': algorithm, 'use': 'sig'})
+    return jwk
+
+def jwk_thumbprint(jwk):
+    # RFC 7638: SHA-256 over the required members in lexicographic order.
+    required = {
+        'RSA': ('e', 'kty', 'n'), 'EC': ('crv', 'kty', 'x', 'y'), 'OKP': ('crv', 'kty', 'x'), 'oct': ('k', 'kty'),
+    }[jwk['kty']]
+    canonical = json.dumps({name: jwk[name] for name in required}, separators=(',', ':'), sort_keys=True)
+    return _b64url(hashlib.sha256(canonical.encode('utf-8')).digest())
+
+class _KeyEntry:
+    __slots__ = ('algorithm', 'signer', 'verifier', 'retired_at')
+
+    def __init__(self, algorithm, signer, verifier):
+        self.algorithm = algorithm
+        self.signer = signer
+        self.verifier = verifier
+        self.retired_at = None
+
+class KeyRing:
+    # Keys by kid. New tokens are signed with the current key and carry its
+    # kid; decode looks the verification key up by kid. Rotating adds a key
+    # and retires the previous one, which keeps verifying for retire_after
+    # seconds (the longest token lifetime) and is then dropped, so existing
+    # tokens are never re-signed. epoch changes whenever a key is dropped or
+    # replaced, which invalidates verified-token cache entries.
+    def __init__(self, retire_after=None):
+        self.retire_after = retire_after
+        self.current_kid = None
+        self._epoch = object()
+        self._next_expiry = None
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    @property
+    def epoch(self):
+        # O(1) unless a retired key is due to be dropped
+        if self._next_expiry is not None and time.time() > self._next_expiry:
+            self.prune()
+        return self._epoch
+
+    def _retire(self, entry):
+        entry.retired_at = time.time()
+        if self.retire_after is not None:
+            expiry = entry.retired_at + self.retire_after
+            if self._next_expiry is None or expiry < self._next_expiry:
+                self._next_expiry = expiry
+
+    def add(self, kid, algorithm, signing_key=None, verification_key=None, current=True):
+        signer = signing_key
+        if signing_key is not None and not isinstance(signing_key, Signer):
+            signer = Signer(algorithm, signing_key)
+        if verification_key is None:
+            if signer is None:
+                raise ValueError("A signing or verification key is required")
+            verification_key = signer.verification_key()
+        entry = _KeyEntry(algorithm, signer, Verifier(algorithm, verification_key))
+        with self._lock:
+            if kid in self._keys:
+                # tokens verified with the replaced key must not be served
+                # from the verified-token cache
+                self._epoch = object()
+            self._keys[kid] = entry
+            if current and signer is not None:
+                self.current_kid = kid
+        return kid
+
+    def rotate(self, kid, algorithm, signing_key, verification_key=None):
+        with self._lock:
+            previous = self._keys.get(self.current_kid)
+        self.add(kid, algorithm, signing_key, verification_key)
+        if previous is not None:
+            self._retire(previous)
+        self.prune()
+        return kid
+
+    def retire(self, kid):
+        with self._lock:
+            entry = self._keys.get(kid)
+            if entry is not None and entry.retired_at is None:
+                self._retire(entry)
+                if self.current_kid == kid:
+                    self.current_kid = None
+
+    def remove(self, kid):
+        with self._lock:
+            if self._keys.pop(kid, None) is None:
+                return False
+            if self.current_kid == kid:
+                self.current_kid = None
+            self._epoch = object()
+            return True
+
+    def _expired(self, entry, now):
+        return (entry.retired_at is not None and self.retire_after is not None
+                and now - entry.retired_at > self.retire_after)
+
+    def prune(self):
+        now = time.time()
+        with self._lock:
+            expired = [kid for kid, entry in self._keys.items() if self._expired(entry, now)]
+            pending = [entry.retired_at + self.retire_after for entry in self._keys.values()
+                       if entry.retired_at is not None and self.retire_after is not None]
+            self._next_expiry = min(pending) if pending else None
+        for kid in expired:
+            self.remove(kid)
+        return len(expired)
+
+    def signer(self):
+        # (kid, Signer) for the current key
+        with self._lock:
+            kid = self.current_kid
+            entry = self._keys.get(kid)
+        if entry is None:
+            raise ValueError("Key ring has no current signing key")
+        return kid, entry.signer
+
+    def verifier(self, kid, algorithm):
+        # Tokens without a kid (issued before the ring) use the current key.
+        entry = self._keys.get(kid if kid is not None else self.current_kid)
+        if entry is None:
+            raise ValueError("Unknown key id")
+        if entry.algorithm != algorithm:
+            raise ValueError("Algorithm does not match key")
+        if self._expired(entry, time.time()):
+            self.remove(kid)
+            raise ValueError("Key has been retired")
+        return entry.verifier
+
+    def __contains__(self, kid):
+        return kid in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def kids(self):
+        return list(self._keys)
+
+    def to_jwks(self, include_private=False):
+        keys = []
+        for kid, entry in list(self._keys.items()):
+            if entry.algorithm in _HMAC_DIGESTS and not include_private:
+                continue  # shared secrets are never published
+            signing_key = entry.signer.key if entry.signer is not None else None
+            keys.append(keys_to_jwk(kid, entry.algorithm, signing_key, entry.verifier.key, include_private))
+        return {'keys': keys}
+
+    def save_jwks(self, path, include_private=False):
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.to_jwks(include_private), f)
+        os.replace(temp_path, path)
+
+    def load_jwks(self, path):
+        # The last key with a private part becomes the current signing key.
+        with open(path) as f:
+            jwks = json.load(f)
+        for jwk in jwks.get('keys', []):
+            kid, algorithm, signing_key, verification_key = jwk_to_keys(jwk)
+            if kid is None:
+                kid = jwk_thumbprint(jwk)
+            self.add(kid, algorithm, signing_key, verification_key)
+        return self
+
+    @classmethod
+    def from_jwks(cls, path, retire_after=None):
+        return cls(retire_after).load_jwks(path)
+
+class VerifiedTokenCache:
+    # LRU of payloads whose signature has already been checked, keyed by a
+    # digest of the whole token. Each entry remembers the key it was verified
+    # with, so a decode with any other key is a miss. Entries are dropped once
+    # the token's exp passes; exp, nbf and custom claims are still checked by
+    # decode on every hit.
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _digest(jwt_token):
+        return hashlib.blake2b(jwt_token.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, jwt_token, key):
+        digest = self._digest(jwt_token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                entry_key, payload, expires = entry
+                if expires is not None and time.time() > expires:
+                    del self._entries[digest]
+                elif entry_key == key:
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    return payload
+            self.misses += 1
+            return None
+
+    def set(self, jwt_token, key, payload):
+        expires = payload.get('exp')
+        if not isinstance(expires, (int, float)):
+            expires = None
+        elif time.time() > expires:
+            return
+        digest = self._digest(jwt_token)
+        with self._lock:
+            self._entries[digest] = (key, payload, expires)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, jwt_token):
+        with self._lock:
+            return self._entries.pop(self._digest(jwt_token), None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
 class JwT:
-    def __init__(self):
+    def __init__(self, token_cache=None, keyring=None, revocations=None):
         self.private_key = None
         self.public_key = None
         self.tokens = {}  
+        # RevocationStore (or any container of jtis) checked by decode
+        self.revocations = revocations
+        # used by encode/decode when no key is passed explicitly
+        self.keyring = keyring
+        # opt-in: pass True or a VerifiedTokenCache to skip re-verifying
+        # tokens that were already decoded with the same key
+        if token_cache is True:
+            token_cache = VerifiedTokenCache()
+        elif token_cache is False:
+            token_cache = None
+        self.token_cache = token_cache
+        # prepared Signer/Verifier objects by (kind, algorithm, key), so PEM
+        # parsing and hash selection happen once per key
+        self.max_prepared_keys = 256
+        self._prepared = OrderedDict()
+        self._prepared_lock = threading.Lock()
+        self._encoded_headers = {}
+        self._decoded_headers = {}
+        self._pool = None
+        self._pool_workers = 0
+
+    def _prepare(self, kind, algorithm, key):
+        if isinstance(key, kind):
+            return key
+        if not isinstance(key, (str, bytes)):
+            # key objects need no parsing and are not necessarily hashable
+            return kind(algorithm, key)
+        cache_key = (kind, algorithm, key)
+        with self._prepared_lock:
+            prepared = self._prepared.get(cache_key)
+            if prepared is not None:
+                self._prepared.move_to_end(cache_key)
+                return prepared
+        prepared = kind(algorithm, key)
+        with self._prepared_lock:
+            self._prepared[cache_key] = prepared
+            while len(self._prepared) > self.max_prepared_keys:
+                self._prepared.popitem(last=False)
+        return prepared
+
+    def signer(self, algorithm, key):
+        return self._prepare(Signer, algorithm, key)
+
+    def verifier(self, algorithm, key):
+        return self._prepare(Verifier, algorithm, key)
 
     def encode(self, payload, secret_key=None, private_key=None, algorithm='HS256', exp=None, nbf=None, aud=None, iss=None, custom_claims=None):
-        header = {'alg': algorithm, 'typ': 'JWT'}
-        encoded_header = self._base64_encode(header)
+        kid = signer = None
+        if secret_key is None and private_key is None and self.keyring is not None:
+            kid, signer = self.keyring.signer()
+            algorithm = signer.algorithm
+        encoded_header = self._encoded_headers.get((algorithm, kid))
+        if encoded_header is None:
+            header = {'alg': algorithm, 'typ': 'JWT'}
+            if kid is not None:
+                header['kid'] = kid
+            encoded_header = self._encoded_headers[(algorithm, kid)] = self._base64_encode(header)
         
         current_time = datetime.datetime.utcnow()
         iat = current_time.timestamp()
@@ -37,14 +573,16 @@ class JwT:
         
         encoded_payload = self._base64_encode(payload)
         
-        if algorithm.startswith('HS'):
+        if signer is not None:
+            signature = signer.sign(encoded_header + '.' + encoded_payload)
+        elif algorithm.startswith('HS'):
             if not secret_key:
                 raise ValueError("Secret key is required for HMAC algorithm")
-            signature = self._sign_hmac(encoded_header + '.' + encoded_payload, secret_key, algorithm)
-        elif algorithm.startswith('RS'):
+            signature = self.signer(algorithm, secret_key).sign(encoded_header + '.' + encoded_payload)
+        elif algorithm in _ASYMMETRIC_ALGORITHMS:
             if not private_key:
-                raise ValueError("Public key is required for RSA algorithm")
-            signature = self._sign_rsa(encoded_header + '.' + encoded_payload, private_key, algorithm)
+                raise ValueError(f"Private key is required for {algorithm}")
+            signature = self.signer(algorithm, private_key).sign(encoded_header + '.' + encoded_payload)
         else:
             raise ValueError("Unsupported algorithm")
         
@@ -52,30 +590,32 @@ class JwT:
         return jwt_token
     
     def decode(self, jwt_token, secret_key=None, public_key=None, custom_claims=None):
-        encoded_header, encoded_payload, signature = jwt_token.split('.')
-        header = json.loads(self._base64_decode(encoded_header))
-        payload = json.loads(self._base64_decode(encoded_payload))
-        
-        algorithm = header.get('alg')
-        if not algorithm:
-            raise ValueError("Missing algorithm in header")
-        
-        if algorithm.startswith('HS'):
-            if not secret_key:
-                raise ValueError("Secret key is required for HMAC algorithm")
-            calculated_signature = self._sign_hmac(encoded_header + '.' + encoded_payload, secret_key, algorithm)
-        elif algorithm.startswith('RS'):
-            if not public_key:
-                raise ValueError("Public key is required for RSA algorithm")
-            if not self._verify_rsa(encoded_header + '.' + encoded_payload, signature, public_key, algorithm):
-                raise ValueError("Invalid signature")
-            calculated_signature = signature
-        else:
-            raise ValueError("Unsupported algorithm")
-        
-        if calculated_signature != signature:
-            raise ValueError("Invalid signature")
-        
+        payload = self._decode(jwt_token, secret_key, public_key, custom_claims)
+        self._check_revoked(payload)
+        return payload
+
+    def _decode(self, jwt_token, secret_key=None, public_key=None, custom_claims=None):
+        cache = self.token_cache
+        payload = None
+        if cache is not None:
+            key = self._cache_identity(secret_key, public_key)
+            payload = cache.get(jwt_token, key)
+        if payload is None:
+            payload = self._verify(jwt_token, secret_key, public_key)
+            if cache is not None:
+                cache.set(jwt_token, key, payload)
+        # callers may modify the payload; never hand out the cached dict
+        payload = dict(payload)
+        self._check_claims(payload, custom_claims)
+        return payload
+
+    def _cache_identity(self, secret_key, public_key):
+        key = secret_key if secret_key is not None else public_key
+        if key is None and self.keyring is not None:
+            key = self.keyring.epoch
+        return key
+
+    def _check_claims(self, payload, custom_claims=None):
         current_time = datetime.datetime.utcnow()
 
         if 'exp' in payload and current_time.timestamp() > payload['exp']:
@@ -91,8 +631,152 @@ class JwT:
                     raise ValueError(f"Custom claim '{claim_name}' is missing")
                 if payload[claim_name] != claim_value:
                     raise ValueError(f"Custom claim '{claim_name}' has invalid value")
-        
+
+    def _check_revoked(self, payload):
+        revocations = self.revocations
+        if revocations is not None and 'jti' in payload and payload['jti'] in revocations:
+            raise ValueError("Token has been revoked")
+
+    def _parse(self, jwt_token):
+        parts = jwt_token.split('.')
+        if len(parts) != 3:
+            raise ValueError("Invalid token format")
+        encoded_header, encoded_payload, signature = parts
+        header = self._decoded_headers.get(encoded_header)
+        if header is None:
+            header = json.loads(self._base64_decode(encoded_header))
+            # checked before any key lookup, so unauthenticated input can only
+            # ever fail as ValueError
+            if (not isinstance(header, dict) or not isinstance(header.get('alg'), str)
+                    or not isinstance(header.get('kid'), (str, type(None)))):
+                raise ValueError("Invalid token format")
+            # only a handful of distinct headers exist; don't let junk grow it
+            if len(self._decoded_headers) < 64:
+                self._decoded_headers[encoded_header] = header
+        return header, encoded_header + '.' + encoded_payload, encoded_payload, signature
+
+    def _load_payload(self, encoded_payload):
+        payload = json.loads(self._base64_decode(encoded_payload))
+        if not isinstance(payload, dict):
+            raise ValueError("Invalid token format")
         return payload
+
+    def _verifier_for(self, header, secret_key=None, public_key=None):
+        algorithm = header.get('alg')
+        if not algorithm:
+            raise ValueError("Missing algorithm in header")
+        
+        if secret_key is None and public_key is None and self.keyring is not None:
+            return self.keyring.verifier(header.get('kid'), algorithm)
+        if algorithm.startswith('HS'):
+            if not secret_key:
+                raise ValueError("Secret key is required for HMAC algorithm")
+            return self.verifier(algorithm, secret_key)
+        if algorithm in _ASYMMETRIC_ALGORITHMS:
+            if not public_key:
+                raise ValueError(f"Public key is required for {algorithm}")
+            return self.verifier(algorithm, public_key)
+        raise ValueError("Unsupported algorithm")
+
+    def _verify(self, jwt_token, secret_key=None, public_key=None):
+        header, signing_input, encoded_payload, signature = self._parse(jwt_token)
+        verifier = self._verifier_for(header, secret_key, public_key)
+        if not verifier.verify(signing_input, signature):
+            raise ValueError("Invalid signature")
+        return self._load_payload(encoded_payload)
+
+    def _verify_group(self, verifier, items):
+        # items are (index, signing_input, encoded_payload, signature)
+        results = []
+        for index, signing_input, encoded_payload, signature in items:
+            try:
+                if not verifier.verify(signing_input, signature):
+                    raise ValueError("Invalid signature")
+                results.append((index, self._load_payload(encoded_payload), None))
+            except ValueError as error:
+                results.append((index, None, error))
+        return results
+
+    def _executor(self, max_workers=None):
+        with self._prepared_lock:
+            if self._pool is None:
+                self._pool_workers = max_workers or os.cpu_count() or 1
+                self._pool = ThreadPoolExecutor(max_workers=self._pool_workers)
+            return self._pool
+
+    def decode_many(self, jwt_tokens, secret_key=None, public_key=None, custom_claims=None, max_workers=None):
+        # Returns one (payload, error) pair per token, in input order. Tokens
+        # are grouped by verifier, so each key is resolved once per batch.
+        # Asymmetric groups are verified in chunks on a thread pool, since
+        # cryptography releases the GIL while verifying; HMAC groups run
+        # inline, where threads would cost more than they save.
+        jwt_tokens = list(jwt_tokens)
+        results = [None] * len(jwt_tokens)
+        cache = self.token_cache
+        identity = self._cache_identity(secret_key, public_key)
+        groups = {}
+        verifiers = {}
+        for index, jwt_token in enumerate(jwt_tokens):
+            try:
+                payload = cache.get(jwt_token, identity) if cache is not None else None
+                if payload is not None:
+                    results[index] = payload
+                    continue
+                header, signing_input, encoded_payload, signature = self._parse(jwt_token)
+                # resolved once per (alg, kid): key objects are not cached by
+                # _prepare, and each new Verifier would start its own group
+                lookup = (header['alg'], header.get('kid'))
+                verifier = verifiers.get(lookup)
+                if verifier is None:
+                    verifier = verifiers[lookup] = self._verifier_for(header, secret_key, public_key)
+            except (ValueError, TypeError, AttributeError) as error:
+                # one malformed token (or non-string item) must not fail the batch
+                results[index] = error
+                continue
+            groups.setdefault(verifier, []).append((index, signing_input, encoded_payload, signature))
+
+        verified = []
+        futures = []
+        for verifier, items in groups.items():
+            if verifier.algorithm in _HMAC_DIGESTS or len(items) == 1:
+                verified.extend(self._verify_group(verifier, items))
+                continue
+            pool = self._executor(max_workers)
+            chunk = max(8, -(-len(items) // (self._pool_workers * 4)))
+            for start in range(0, len(items), chunk):
+                futures.append(pool.submit(self._verify_group, verifier, items[start:start + chunk]))
+        for future in futures:
+            verified.extend(future.result())
+        for index, payload, error in verified:
+            if error is not None:
+                results[index] = error
+                continue
+            if cache is not None:
+                cache.set(jwt_tokens[index], identity, payload)
+            results[index] = payload
+
+        for index, result in enumerate(results):
+            if isinstance(result, Exception):
+                results[index] = (None, result)
+                continue
+            payload = dict(result)
+            try:
+                self._check_claims(payload, custom_claims)
+                self._check_revoked(payload)
+            except (ValueError, TypeError) as error:
+                # TypeError: a signed but malformed claim, e.g. a string exp
+                results[index] = (None, error)
+                continue
+            results[index] = (payload, None)
+        return results
+
+    def invalidate_cache(self, jwt_token=None):
+        if self.token_cache is None:
+            return
+        if jwt_token is None:
+            self.token_cache.clear()
+        else:
+            self.token_cache.discard(jwt_token)
     
     def _base64_encode(self, data):
         return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).rstrip(b'=').decode('utf-8')
@@ -103,69 +787,30 @@ class JwT:
         return base64.urlsafe_b64decode(padded_data.encode('utf-8')).decode('utf-8')
     
     def _sign_hmac(self, data, secret_key, algorithm):
-        if algorithm == 'HS256':
-            hash_algorithm = hashes.SHA256()
-        elif algorithm == 'HS384':
-            hash_algorithm = hashes.SHA384()
-        elif algorithm == 'HS512':
-            hash_algorithm = hashes.SHA512()
-        else:
-            raise ValueError("Unsupported algorithm")
-        
-        key = secret_key.encode('utf-8')
-        h = hmac_primitives.HMAC(key, hash_algorithm)
-        h.update(data.encode('utf-8'))
-        return base64.urlsafe_b64encode(h.finalize()).decode('utf-8')
+        return self.signer(algorithm, secret_key).sign(data)
     
     def _sign_rsa(self, data, private_key, algorithm):
-        from cryptography.hazmat.primitives.asymmetric import utils
-        
-        if algorithm == 'RS256':
-            padding_algorithm = padding.PKCS1v15()
-            hash_algorithm = hashes.SHA256()
-        elif algorithm == 'RS384':
-            padding_algorithm = padding.PKCS1v15()
-            hash_algorithm = hashes.SHA384()
-        elif algorithm == 'RS512':
-            padding_algorithm = padding.PKCS1v15()
-            hash_algorithm = hashes.SHA512()
-        else:
-            raise ValueError("Unsupported algorithm")
-        
-        key = serialization.load_pem_private_key(private_key.encode('utf-8'), password=None)
-        signature = key.sign(data.encode('utf-8'), padding_algorithm, hash_algorithm)
-        return base64.urlsafe_b64encode(signature).decode('utf-8')
+        return self.signer(algorithm, private_key).sign(data)
     
     def _verify_rsa(self, data, signature, public_key, algorithm):
-        from cryptography.hazmat.primitives.asymmetric import padding
-        
-        if algorithm == 'RS256':
-            padding_algorithm = padding.PKCS1v15()
-            hash_algorithm = hashes.SHA256()
-        elif algorithm == 'RS384':
-            padding_algorithm = padding.PKCS1v15()
-            hash_algorithm = hashes.SHA384()
-        elif algorithm == 'RS512':
-            padding_algorithm = padding.PKCS1v15()
-            hash_algorithm = hashes.SHA512()
+        return self.verifier(algorithm, public_key).verify(data, signature)
+    
+    def generate_private_key(self, algorithm='RS256'):
+        if algorithm in _EC_ALGORITHMS:
+            private_key = ec.generate_private_key(_EC_ALGORITHMS[algorithm][1]())
+        elif algorithm == 'EdDSA':
+            private_key = ed25519.Ed25519PrivateKey.generate()
+        elif algorithm in _RSA_HASHES:
+            private_key = rsa.generate_private_key(
+                public_exponent=65537,
+                key_size=2048,
+            )
         else:
             raise ValueError("Unsupported algorithm")
-        
-        key = serialization.load_pem_public_key(public_key.encode('utf-8'))
-        try:
-            key.verify(base64.urlsafe_b64decode(signature), data.encode('utf-8'), padding_algorithm, hash_algorithm)
-            return True
-        except:
-            return False
-    
-    def generate_private_key(self):
-        private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-        )
         private_key_pem = private_key.private_bytes(
             encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            # Ed25519 keys have no "traditional" encoding
+            format=serialization.PrivateFormat.PKCS8 if algorithm == 'EdDSA' else serialization.PrivateFormat.TraditionalOpenSSL,
             encryption_algorithm=serialization.NoEncryption()
         )
         return private_key_pem.decode('utf-8')
@@ -188,7 +833,7 @@ class JwT:
     def generate_refresh_token(self, secret_key, user_id):
         return self.encode({'sub': user_id, 'type': 'refresh'}, secret_key, algorithm='HS256', exp=2592000)  # 30 days
 
-    def generate_access_token(self, secret_key=None, public_key=None, user_id=None, scopes=None, custom_claims=None):
+    def generate_access_token(self, secret_key=None, private_key=None, user_id=None, scopes=None, custom_claims=None, algorithm=None):
         if not user_id:
             raise ValueError("User ID is required to generate an access token")
         
@@ -200,53 +845,65 @@ class JwT:
         if custom_claims:
             payload.update(custom_claims)
         
-        return self.encode(payload, secret_key=secret_key, public_key=public_key, algorithm='HS256')
+        if algorithm is None:
+            if isinstance(private_key, Signer):
+                algorithm = private_key.algorithm
+            else:
+                algorithm = 'RS256' if private_key is not None else 'HS256'
+        return self.encode(payload, secret_key=secret_key, private_key=private_key, algorithm=algorithm)
         
-    def extend_expiration(self, jwt_token, new_exp=None):
-        payload = self.decode(jwt_token, secret_key=None, public_key=None)
+    def extend_expiration(self, jwt_token, new_exp=None, secret_key=None, public_key=None, private_key=None):
+        # Without keys, the token is verified and re-signed with the keyring.
+        payload = self.decode(jwt_token, secret_key=secret_key, public_key=public_key)
         
         if new_exp is not None:
             payload['exp'] = new_exp
         
-        return self.encode(payload, secret_key=None, public_key=None)
+        algorithm = json.loads(self._base64_decode(jwt_token.split('.')[0])).get('alg', 'HS256')
+        return self.encode(payload, secret_key=secret_key, private_key=private_key, algorithm=algorithm)
     
-    def revoke_token(self, jwt_token, blacklist):
-        payload = self.decode(jwt_token, secret_key=None, public_key=None)
+    def revoke_token(self, jwt_token, blacklist=None, secret_key=None, public_key=None):
+        # Records the token's jti in blacklist, or in self.revocations when no
+        # blacklist is given; a RevocationStore also keeps it until exp.
+        payload = self._decode(jwt_token, secret_key=secret_key, public_key=public_key)
         
         jti = payload.get('jti')
         if not jti:
             return False
         
-        if jti in blacklist:
-            return False
+        if blacklist is None:
+            blacklist = self.revocations
+        if blacklist is None:
+            raise ValueError("No revocation store configured")
         
-        blacklist.add(jti)
-        return True
+        if isinstance(blacklist, RevocationStore):
+            revoked = blacklist.revoke(jti, payload.get('exp'))
+        elif jti in blacklist:
+            revoked = False
+        else:
+            blacklist.add(jti)
+            revoked = True
+        
+        self.invalidate_cache(jwt_token)
+        return revoked
     
-    def rotate_keys(self):
-        new_private_key = self.generate_private_key()
+    def rotate_keys(self, retire_after=None, algorithm='RS256'):
+        # Adds a new key to the keyring and makes it current. Tokens signed
+        # with earlier keys keep verifying by kid until retire_after seconds
+        # have passed, so nothing is re-encoded; the last element of the
+        # returned tuple is always empty and kept for compatibility.
+        new_private_key = self.generate_private_key(algorithm)
         new_public_key = self.generate_public_key(new_private_key)
 
-        if self.private_key and self.public_key:
-            updated_tokens = self._reencode_tokens(self.private_key, new_private_key, self.public_key, new_public_key)
-        else:
-            updated_tokens = {}
+        if self.keyring is None:
+            self.keyring = KeyRing(retire_after)
+        elif retire_after is not None:
+            self.keyring.retire_after = retire_after
+        signer = Signer(algorithm, new_private_key)
+        kid = jwk_thumbprint(keys_to_jwk(None, algorithm, verification_key=signer.verification_key()))
+        self.keyring.rotate(kid, algorithm, signer)
 
         self.private_key = new_private_key
         self.public_key = new_public_key
 
-        return new_private_key, new_public_key, updated_tokens
-
-    def _reencode_tokens(self, old_private_key, new_private_key, old_public_key, new_public_key):
-        updated_tokens = {}
-
-        for old_token, old_token_payload in self.tokens.items():
-            try:
-                decoded_payload = self.decode(old_token, secret_key=None, public_key=old_public_key)
-            except ValueError:
-                continue
-
-            new_token = self.encode(decoded_payload, secret_key=None, public_key=new_public_key)
-            updated_tokens[old_token] = new_token
-
-        return updated_tokens
+        return new_private_key, new_public_key, {}
@@ -1,14 +1,26 @@
+import array
+import asyncio
 import hashlib
+import hmac
 import secrets
 import base64
+import io
+import struct
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import os
 import random
 import string
 import re
+import sys
+import threading
 import time
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from html.parser import HTMLParser
 
 SALT_LENGTH = 16
@@ -20,27 +32,34 @@ def generate_salt():
 def generate_pepper():
     return secrets.token_bytes(PEPPER_LENGTH)
 
-def hash_password(password):
-    salt = generate_salt()
-    pepper = b'$emonic.chiper@'
-    combined = salt + password.encode() + pepper
+LEGACY_HASH_PREFIX = '$emonic.chiper@'
 
-    for _ in range(20):
-        combined = hashlib.sha3_512(combined).digest()
-        combined = hashlib.sha3_256(combined).digest()
+# Hashes are stored as $emonic$<algorithm>$<k=v,...>$<salt>$<hash> with
+# unpadded base64 salt and hash, so the cost can be raised per deployment
+# while older hashes keep verifying and are flagged for rehashing.
+PASSWORD_HASH_DEFAULTS = {
+    'scrypt': {'n': 2 ** 15, 'r': 8, 'p': 1},
+    'pbkdf2-sha256': {'i': 600000},
+    'pbkdf2-sha512': {'i': 210000},
+}
+_password_hashing = {'algorithm': 'scrypt', 'params': dict(PASSWORD_HASH_DEFAULTS['scrypt'])}
 
-    iterations = 2000000
-    for _ in range(iterations):
-        combined = hashlib.sha3_512(combined).digest()
+def _b64encode(data):
+    return base64.b64encode(data).rstrip(b'=').decode('ascii')
 
-    final_hash = '$emonic.chiper@' + salt.hex() + combined.hex()
-    return final_hash
+def _b64decode(data):
+    return base64.b64decode(data + '=' * (-len(data) % 4))
 
-def verify_password(password, hashed_password):
-    prefix = '$emonic.chiper@'
-    salt_hex = hashed_password[len(prefix): len(prefix) + 32]
-    combined_hash = hashed_password[len(prefix) + 32:]
-    combined = bytes.fromhex(salt_hex) + password.encode() + prefix.encode()
+def _derive_password_key(algorithm, params, password, salt):
+    if algorithm == 'scrypt':
+        n, r, p = params['n'], params['r'], params['p']
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=128 * n * r * (p + 1) + 2 ** 20, dklen=32)
+    if algorithm in ('pbkdf2-sha256', 'pbkdf2-sha512'):
+        return hashlib.pbkdf2_hmac(algorithm[7:], password, salt, params['i'])
+    raise ValueError(f"Unsupported password hash algorithm '{algorithm}'.")
+
+def _legacy_password_digest(password, salt):
+    combined = salt + password.encode() + LEGACY_HASH_PREFIX.encode()
 
     for _ in range(20):
         combined = hashlib.sha3_512(combined).digest()
@@ -50,21 +69,280 @@ def verify_password(password, hashed_password):
     for _ in range(iterations):
         combined = hashlib.sha3_512(combined).digest()
 
-    combined_hex = combined.hex()
-    generated_hash = prefix + salt_hex + combined_hex
-    return generated_hash == hashed_password
+    return combined
+
+def configure_password_hashing(algorithm='scrypt', **params):
+    if algorithm not in PASSWORD_HASH_DEFAULTS:
+        raise ValueError(f"Unsupported password hash algorithm '{algorithm}'.")
+    merged = dict(PASSWORD_HASH_DEFAULTS[algorithm])
+    merged.update(params)
+    _password_hashing['algorithm'] = algorithm
+    _password_hashing['params'] = merged
+    return algorithm, merged
+
+def password_hashing_config():
+    return _password_hashing['algorithm'], dict(_password_hashing['params'])
+
+def calibrate_password_hashing(target_seconds=0.25, algorithm='scrypt', apply=True):
+    # Doubles the cost parameter until one hash on this host takes at least
+    # target_seconds, starting from a cheap setting.
+    params = dict(PASSWORD_HASH_DEFAULTS[algorithm])
+    cost_key = 'n' if algorithm == 'scrypt' else 'i'
+    params[cost_key] = 2 ** 12 if algorithm == 'scrypt' else 10000
+    salt = generate_salt()
+    while True:
+        start = time.perf_counter()
+        _derive_password_key(algorithm, params, b'calibration', salt)
+        elapsed = time.perf_counter() - start
+        if elapsed >= target_seconds or (algorithm == 'scrypt' and params['n'] >= 2 ** 20):
+            break
+        if algorithm == 'scrypt':
+            params['n'] *= 2
+        else:
+            params['i'] = int(params['i'] * max(2.0, min(target_seconds / max(elapsed, 1e-6), 10.0)))
+    if apply:
+        configure_password_hashing(algorithm, **params)
+    return algorithm, params
+
+def hash_password(password, algorithm=None, **params):
+    if algorithm is None:
+        algorithm, defaults = password_hashing_config()
+    else:
+        defaults = dict(PASSWORD_HASH_DEFAULTS.get(algorithm, {}))
+    defaults.update(params)
+    salt = generate_salt()
+    digest = _derive_password_key(algorithm, defaults, password.encode(), salt)
+    encoded_params = ','.join(f'{key}={value}' for key, value in sorted(defaults.items()))
+    return f'$emonic${algorithm}${encoded_params}${_b64encode(salt)}${_b64encode(digest)}'
+
+def _parse_password_hash(hashed_password):
+    parts = hashed_password.split('$')
+    if len(parts) != 6 or parts[0] or parts[1] != 'emonic':
+        raise ValueError("Unrecognized password hash format.")
+    _, _, algorithm, encoded_params, salt, digest = parts
+    params = {}
+    for item in encoded_params.split(','):
+        key, _, value = item.partition('=')
+        params[key] = int(value)
+    return algorithm, params, _b64decode(salt), _b64decode(digest)
+
+def verify_password(password, hashed_password):
+    if hashed_password.startswith(LEGACY_HASH_PREFIX):
+        salt_hex = hashed_password[len(LEGACY_HASH_PREFIX): len(LEGACY_HASH_PREFIX) + 32]
+        expected = hashed_password[len(LEGACY_HASH_PREFIX) + 32:]
+        combined = _legacy_password_digest(password, bytes.fromhex(salt_hex))
+        return hmac.compare_digest(combined.hex(), expected)
+    try:
+        algorithm, params, salt, expected = _parse_password_hash(hashed_password)
+        digest = _derive_password_key(algorithm, params, password.encode(), salt)
+    except (ValueError, KeyError):
+        return False
+    return hmac.compare_digest(digest, expected)
+
+def needs_rehash(hashed_password):
+    if hashed_password.startswith(LEGACY_HASH_PREFIX):
+        return True
+    try:
+        algorithm, params, _, _ = _parse_password_hash(hashed_password)
+    except ValueError:
+        return True
+    current_algorithm, current_params = password_hashing_config()
+    return algorithm != current_algorithm or params != current_params
+
+def verify_and_update(password, hashed_password):
+    # Returns (valid, new_hash); new_hash is set when the stored hash uses an
+    # outdated format or cost and should be replaced after this login.
+    if not verify_password(password, hashed_password):
+        return False, None
+    if needs_rehash(hashed_password):
+        return True, hash_password(password)
+    return True, None
+
+def _verify_and_update_with(password, hashed_password, algorithm, params):
+    configure_password_hashing(algorithm, **params)
+    return verify_and_update(password, hashed_password)
+
+class HashingQueueFull(RuntimeError):
+    pass
+
+class PasswordHasher:
+    # Runs hash_password/verify_password in a dedicated process pool so the
+    # KDF neither blocks the calling worker thread nor holds its GIL. At most
+    # max_pending hashes may be running or queued; beyond that calls fail
+    # fast with HashingQueueFull instead of letting logins pile up.
+    def __init__(self, max_workers=None, max_pending=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending if max_pending is not None else self.max_workers * 4
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._pool
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._pending -= 1
+
+    def _submit(self, func, *args, **kwargs):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise HashingQueueFull("Too many password hashes pending.")
+            self._pending += 1
+        try:
+            future = self._executor().submit(func, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def submit_hash(self, password):
+        # pass the parent's settings explicitly; pool processes may predate them
+        algorithm, params = password_hashing_config()
+        return self._submit(hash_password, password, algorithm, **params)
+
+    def submit_verify(self, password, hashed_password):
+        return self._submit(verify_password, password, hashed_password)
+
+    def submit_verify_and_update(self, password, hashed_password):
+        algorithm, params = password_hashing_config()
+        return self._submit(_verify_and_update_with, password, hashed_password, algorithm, params)
+
+    def hash(self, password, timeout=None):
+        return self.submit_hash(password).result(timeout)
+
+    def verify(self, password, hashed_password, timeout=None):
+        return self.submit_verify(password, hashed_password).result(timeout)
+
+    def verify_and_update(self, password, hashed_password, timeout=None):
+        return self.submit_verify_and_update(password, hashed_password).result(timeout)
+
+    async def ahash(self, password):
+        return await asyncio.wrap_future(self.submit_hash(password))
+
+    async def averify(self, password, hashed_password):
+        return await asyncio.wrap_future(self.submit_verify(password, hashed_password))
+
+    async def averify_and_update(self, password, hashed_password):
+        return await asyncio.wrap_future(self.submit_verify_and_update(password, hashed_password))
+
+    def pending(self):
+        return self._pending
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+ENCRYPTION_SALT_LENGTH = 16
+ENCRYPTION_KDF_ITERATIONS = 100000
+
+def _derive_encryption_key(password, salt):
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=ENCRYPTION_KDF_ITERATIONS,
+    )
+    return bytearray(kdf.derive(password.encode()))
+
+class DerivedKeyCache:
+    # Bounded, TTL'd cache of PBKDF2-derived keys and their Fernet objects,
+    # keyed by an HMAC of (salt, password) under a per-process secret so the
+    # password itself is never stored. Evicted and cleared keys are
+    # overwritten in place; Fernet keeps its own copy, so zeroizing is best
+    # effort.
+    def __init__(self, max_entries=128, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._secret = secrets.token_bytes(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cache_key(self, password, salt):
+        return hmac.new(self._secret, salt + b'\0' + password.encode(), hashlib.sha256).digest()
+
+    @staticmethod
+    def _zeroize(entry):
+        key = entry[0]
+        for i in range(len(key)):
+            key[i] = 0
+
+    def get(self, password, salt):
+        cache_key = self._cache_key(password, salt)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                if entry[2] > now:
+                    self._entries.move_to_end(cache_key)
+                    return entry[1]
+                self._zeroize(self._entries.pop(cache_key))
+
+        key = _derive_encryption_key(password, salt)
+        cipher_suite = Fernet(base64.urlsafe_b64encode(bytes(key)))
+        with self._lock:
+            previous = self._entries.pop(cache_key, None)
+            if previous is not None:
+                self._zeroize(previous)
+            self._entries[cache_key] = (key, cipher_suite, now + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._zeroize(self._entries.popitem(last=False)[1])
+        return cipher_suite
+
+    def clear(self):
+        with self._lock:
+            for entry in self._entries.values():
+                self._zeroize(entry)
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+_derived_keys = DerivedKeyCache()
+
+def clear_key_cache():
+    _derived_keys.clear()
+
+class KeyedCipher:
+    # Derives the key for (password, salt) once and reuses the Fernet object.
+    # Output is salt + token, the same format as encrypt_data, so either side
+    # can decrypt the other's data; ciphertexts under another salt go through
+    # the shared derived-key cache.
+    def __init__(self, password, salt=None, cache=None):
+        self._password = password
+        self.salt = salt if salt is not None else os.urandom(ENCRYPTION_SALT_LENGTH)
+        self._cache = cache if cache is not None else _derived_keys
+        self._cipher_suite = self._cache.get(password, self.salt)
+
+    def _cipher_for(self, salt):
+        if salt == self.salt:
+            return self._cipher_suite
+        return self._cache.get(self._password, salt)
+
+    def encrypt(self, plaintext):
+        return self.salt + self._cipher_suite.encrypt(plaintext.encode())
+
+    def decrypt(self, ciphertext):
+        salt = ciphertext[:ENCRYPTION_SALT_LENGTH]
+        return self._cipher_for(salt).decrypt(ciphertext[ENCRYPTION_SALT_LENGTH:]).decode()
+
+    def encrypt_many(self, plaintexts):
+        return [self.encrypt(plaintext) for plaintext in plaintexts]
+
+    def decrypt_many(self, ciphertexts):
+        return [self.decrypt(ciphertext) for ciphertext in ciphertexts]
 
 def encrypt_data(password, plaintext):
     try:
-        salt = os.urandom(16)
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
-        cipher_suite = Fernet(key)
+        salt = os.urandom(ENCRYPTION_SALT_LENGTH)
+        key = _derive_encryption_key(password, salt)
+        cipher_suite = Fernet(base64.urlsafe_b64encode(bytes(key)))
 
         cipher_text = cipher_suite.encrypt(plaintext.encode())
         return salt + cipher_text
@@ -75,16 +353,9 @@ def encrypt_data(password, plaintext):
 
 def decrypt_data(password, ciphertext):
     try:
-        salt = ciphertext[:16]
-        cipher_text = ciphertext[16:]
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
-        cipher_suite = Fernet(key)
+        salt = ciphertext[:ENCRYPTION_SALT_LENGTH]
+        cipher_text = ciphertext[ENCRYPTION_SALT_LENGTH:]
+        cipher_suite = _derived_keys.get(password, salt)
 
         decrypted_text = cipher_suite.decrypt(cipher_text)
         return decrypted_text.decode()
@@ -92,16 +363,324 @@ def decrypt_data(password, ciphertext):
     except Exception as e:
         print("Decryption error:", str(e))
 
+# Streaming format: a header (magic, chunk size, salt, nonce prefix) followed
+# by frames of <4-byte length><AES-GCM ciphertext>. Chunk i is sealed under
+# nonce prefix || i || final-flag with the header as associated data, so
+# reordered, dropped, truncated or appended frames all fail authentication.
+STREAM_MAGIC = b'EMSTRM1\0'
+STREAM_CHUNK_SIZE = 64 * 1024
+_STREAM_HEADER = struct.Struct('>8sI16s7s')
+_STREAM_FRAME = struct.Struct('>I')
+_STREAM_TAG_SIZE = 16
+
+class StreamIntegrityError(ValueError):
+    pass
+
+def _stream_key(password, salt):
+    if isinstance(password, (bytes, bytearray)):
+        if len(password) != 32:
+            raise ValueError("Raw stream keys must be 32 bytes.")
+        return AESGCM(bytes(password))
+    key = _derive_encryption_key(password, salt)
+    try:
+        return AESGCM(bytes(key))
+    finally:
+        for i in range(len(key)):
+            key[i] = 0
+
+def _stream_nonce(prefix, index, final):
+    return prefix + index.to_bytes(4, 'big') + (b'\1' if final else b'\0')
+
+def _read_chunks(src, chunk_size):
+    # Yields (chunk, final). File objects (including mmap) are read
+    # incrementally; other buffers are sliced without copying.
+    if hasattr(src, 'read'):
+        # Raw, socket and length-limited streams return short reads before
+        # EOF, so fill each chunk and only treat an empty read as the end.
+        chunk = _read_exact(src, chunk_size)
+        while True:
+            following = _read_exact(src, chunk_size) if len(chunk) == chunk_size else b''
+            yield chunk, not following
+            if not following:
+                return
+            chunk = following
+    view = memoryview(src).cast('B')
+    total = len(view)
+    offset = 0
+    while True:
+        end = offset + chunk_size
+        yield view[offset:end], end >= total
+        if end >= total:
+            return
+        offset = end
+
+def _read_exact(src, size):
+    data = src.read(size)
+    if not data or len(data) >= size:
+        return data
+    parts = [data]
+    remaining = size - len(data)
+    while remaining:
+        more = src.read(remaining)
+        if not more:
+            break
+        parts.append(more)
+        remaining -= len(more)
+    return b''.join(parts)
+
+def _stream_pipeline(jobs, seal, dst, workers):
+    # Runs seal(job) over jobs and writes results in order. In parallel mode
+    # at most 2 * workers chunks are in flight, so memory stays bounded.
+    written = 0
+    if not workers or workers <= 1:
+        for job in jobs:
+            written += dst.write(seal(job)) or 0
+        return written
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for job in jobs:
+            window.append(pool.submit(seal, job))
+            if len(window) >= workers * 2:
+                written += dst.write(window.popleft().result()) or 0
+        while window:
+            written += dst.write(window.popleft().result()) or 0
+    return written
+
+def encrypt_stream(password, src, dst, chunk_size=STREAM_CHUNK_SIZE, workers=None):
+    # password may be a str (PBKDF2-derived key) or a raw 32-byte key. src is
+    # a readable file object, mmap or bytes-like buffer; dst needs write().
+    # Returns the number of bytes written.
+    if not 0 < chunk_size < 2 ** 32 - _STREAM_TAG_SIZE:
+        raise ValueError("chunk_size out of range.")
+    salt = os.urandom(ENCRYPTION_SALT_LENGTH)
+    prefix = os.urandom(7)
+    header = _STREAM_HEADER.pack(STREAM_MAGIC, chunk_size, salt, prefix)
+    aead = _stream_key(password, salt)
+
+    def jobs():
+        for index, (chunk, final) in enumerate(_read_chunks(src, chunk_size)):
+            if index >= 2 ** 32:
+                raise ValueError("Stream too long for its chunk size.")
+            yield index, chunk, final
+
+    def seal(job):
+        index, chunk, final = job
+        sealed = aead.encrypt(_stream_nonce(prefix, index, final), chunk, header)
+        return _STREAM_FRAME.pack(len(sealed)) + sealed
+
+    dst.write(header)
+    return len(header) + _stream_pipeline(jobs(), seal, dst, workers)
+
+def decrypt_stream(password, src, dst, workers=None):
+    # Raises StreamIntegrityError on tampered, truncated or extended input;
+    # output written before the failure must then be discarded.
+    if not hasattr(src, 'read'):
+        src = io.BytesIO(src)
+    header = _read_exact(src, _STREAM_HEADER.size)
+    if len(header) != _STREAM_HEADER.size:
+        raise StreamIntegrityError("Truncated stream header.")
+    magic, chunk_size, salt, prefix = _STREAM_HEADER.unpack(header)
+    if magic != STREAM_MAGIC:
+        raise StreamIntegrityError("Not an Emonic encrypted stream.")
+    aead = _stream_key(password, salt)
+    max_frame = chunk_size + _STREAM_TAG_SIZE
+
+    def read_frame():
+        frame = _read_exact(src, _STREAM_FRAME.size)
+        if not frame:
+            return None
+        if len(frame) != _STREAM_FRAME.size:
+            raise StreamIntegrityError("Truncated frame header.")
+        (length,) = _STREAM_FRAME.unpack(frame)
+        if not _STREAM_TAG_SIZE <= length <= max_frame:
+            raise StreamIntegrityError("Invalid frame length.")
+        sealed = _read_exact(src, length)
+        if len(sealed) != length:
+            raise StreamIntegrityError("Truncated frame.")
+        return sealed
+
+    def jobs():
+        # One frame of lookahead tells whether the current one is the last;
+        # the final flag in the nonce then rejects truncation and appending.
+        sealed = read_frame()
+        if sealed is None:
+            raise StreamIntegrityError("Stream has no chunks.")
+        index = 0
+        while True:
+            following = read_frame()
+            yield index, sealed, following is None
+            if following is None:
+                return
+            sealed = following
+            index += 1
+
+    def open_chunk(job):
+        index, sealed, final = job
+        try:
+            return aead.decrypt(_stream_nonce(prefix, index, final), sealed, header)
+        except InvalidTag:
+            raise StreamIntegrityError(f"Chunk {index} failed authentication.") from None
+
+    return _stream_pipeline(jobs(), open_chunk, dst, workers)
 
 def generate_id(length=10):
     if length < 2:
         raise ValueError("Length must be at least 2.")
-    starting_char = random.choice(string.ascii_lowercase)
+    starting_char = secrets.choice(string.ascii_lowercase)
     remaining_length = length - 2
-    random_digits = ''.join(random.choice(string.digits) for _ in range(remaining_length))
+    random_digits = ''.join(secrets.choice(string.digits) for _ in range(remaining_length))
     unique_id = starting_char + '-' + random_digits
     return unique_id
 
+# Time-ordered 128-bit IDs: a 48-bit millisecond timestamp followed by a
+# 74-bit counter that is seeded from buffered entropy each millisecond and
+# incremented within it, so IDs from one generator are strictly increasing
+# and sort by creation time. They are unique, not unguessable; use secrets
+# for tokens.
+_CROCKFORD = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+# every 10-bit value as two Crockford base32 characters
+_CROCKFORD_PAIRS = [a + b for a in _CROCKFORD for b in _CROCKFORD]
+_COUNTER_BITS = 74
+_COUNTER_MASK = (1 << _COUNTER_BITS) - 1
+_RAND_B_MASK = (1 << 62) - 1
+_UUID7_BITS = (0x7 << 76) | (0b10 << 62)
+
+class IdGenerator:
+    def __init__(self, entropy_size=4096):
+        self.entropy_size = entropy_size
+        self._lock = threading.Lock()
+        self._reset()
+        _id_generators.add(self)
+
+    def _reset(self):
+        # Also run in forked children, which must not replay the parent's
+        # counter or buffered entropy.
+        self._last_ms = -1
+        self._counter = 0
+        self._entropy = b''
+        self._entropy_offset = 0
+
+    def _seed(self):
+        if self._entropy_offset + 10 > len(self._entropy):
+            self._entropy = os.urandom(self.entropy_size)
+            self._entropy_offset = 0
+        offset = self._entropy_offset
+        self._entropy_offset = offset + 10
+        # top bit clear leaves at least 2**73 increments before overflow
+        return int.from_bytes(self._entropy[offset:offset + 10], 'big') & (_COUNTER_MASK >> 1)
+
+    def _reserve(self, count):
+        # Returns (ms, first counter) for count consecutive IDs.
+        with self._lock:
+            now = time.time_ns() // 1000000
+            if now > self._last_ms:
+                self._last_ms = now
+                self._counter = self._seed()
+            elif self._counter + count > _COUNTER_MASK:
+                # Counter exhausted: borrow the next millisecond rather than
+                # wrap. A clock that went backwards keeps the last one.
+                self._last_ms += 1
+                self._counter = self._seed()
+            first = self._counter + 1
+            self._counter += count
+            return self._last_ms, first
+
+    def new_int(self):
+        ms, counter = self._reserve(1)
+        return (ms << 80) | counter
+
+    def new_ints(self, count):
+        ms, first = self._reserve(count)
+        base = ms << 80
+        return [base | counter for counter in range(first, first + count)]
+
+    @staticmethod
+    def _segments(first, count, bits):
+        # Splits a counter range where the low `bits` bits wrap, so each
+        # segment has a constant high part.
+        mask = (1 << bits) - 1
+        while count:
+            low = first & mask
+            n = min(count, mask + 1 - low)
+            yield first >> bits, low, n
+            first += n
+            count -= n
+
+    @staticmethod
+    def _low_words(start, n):
+        # n consecutive big-endian 64-bit words, built without a Python loop.
+        words = array.array('Q', range(start, start + n))
+        if sys.byteorder == 'little':
+            words.byteswap()
+        return words.tobytes()
+
+    def uuid7(self):
+        value = self.new_int()
+        counter = value & _COUNTER_MASK
+        h = f'{((value >> 80) << 80) | _UUID7_BITS | ((counter >> 62) << 64) | (counter & _RAND_B_MASK):032x}'
+        return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+    def uuid7s(self, count):
+        # The timestamp, version and rand_a fields are shared by a segment,
+        # so only the 64-bit variant/rand_b word differs per ID; its hex
+        # digits are scattered into a dashed template with slice assignment.
+        ms, first = self._reserve(count)
+        ids = []
+        for high, low, n in self._segments(first, count, 62):
+            h = f'{ms:012x}{0x7000 | high:04x}'
+            prefix = f'{h[:8]}-{h[8:12]}-{h[12:16]}-'
+            digits = self._low_words((0b10 << 62) | low, n).hex().encode('ascii')
+            out = bytearray(b'0000-000000000000' * n)
+            for k in range(16):
+                out[k + (k >= 4)::17] = digits[k::16]
+            out = out.decode('ascii')
+            ids.extend([prefix + out[i:i + 17] for i in range(0, n * 17, 17)])
+        return ids
+
+    def ulid(self):
+        return self.ulids(1)[0]
+
+    def ulids(self, count):
+        # Crockford base32, two characters per 10-bit table lookup. The
+        # timestamp and the counter's high 40 bits are encoded once per
+        # segment; only the low 40 bits (8 characters) differ per ID.
+        ms, first = self._reserve(count)
+        t = _CROCKFORD_PAIRS
+        # 48-bit timestamp with 2 bits of padding: 10 characters
+        stamp = t[ms >> 40] + t[ms >> 30 & 1023] + t[ms >> 20 & 1023] + t[ms >> 10 & 1023] + t[ms & 1023]
+        ids = []
+        for high, low, n in self._segments(first, count, 40):
+            prefix = stamp + t[high >> 30 & 1023] + t[high >> 20 & 1023] + t[high >> 10 & 1023] + t[high & 1023]
+            ids.extend([
+                f'{prefix}{t[c >> 30]}{t[c >> 20 & 1023]}{t[c >> 10 & 1023]}{t[c & 1023]}'
+                for c in range(low, low + n)
+            ])
+        return ids
+
+_id_generators = weakref.WeakSet()
+
+def _reset_id_generators():
+    for generator in list(_id_generators):
+        generator._lock = threading.Lock()
+        generator._reset()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_id_generators)
+
+_ids = IdGenerator()
+
+def generate_uuid7():
+    return _ids.uuid7()
+
+def generate_uuid7s(count):
+    return _ids.uuid7s(count)
+
+def generate_ulid():
+    return _ids.ulid()
+
+def generate_ulids(count):
+    return _ids.ulids(count)
+
 def validate_email(email):
     email_regex = r"[^@]+@[^@]+\.[^@]+"
     return re.match(email_regex, email) is not None
@@ -169,38 +748,129 @@ class SanitizeHTMLParser(HTMLParser):
         return re.sub(r"[\'\";]", '', value)
 
 
-def sanitize_input(input_string, sanitize_html=True, sanitize_sql=True, sanitize_nosql=True):
-    if sanitize_html:
-        input_string = sanitize_html_input(input_string)
-
-    if sanitize_sql:
-        input_string = sanitize_sql_input(input_string)
+# One compiled pattern finds the markup (script/style bodies, comments,
+# doctypes and tags); the text between matches and attribute values are
+# filtered with str.translate, so each field is scanned once.
+_SANITIZE_TOKENS = re.compile(
+    r'<(?P<block>script|style)\b.*?(?:</(?P=block)\s*>|\Z)'
+    r'|<!--.*?(?:-->|\Z)'
+    r'|<[!?][^>]*>'
+    r'|<(?P<close>/?)(?P<tag>[a-zA-Z][\w:-]*)(?P<attrs>[^>]*)>'
+    # A tag that is never closed swallows the rest of the input, as
+    # HTMLParser does; passed through as text the browser would complete it
+    # against whatever markup follows in the page.
+    r'|<[a-zA-Z/!?].*',
+    re.DOTALL | re.IGNORECASE,
+)
+_SANITIZE_ATTRS = re.compile(
+    r'(?P<name>[^\s"\'>/=]+)(?:\s*=\s*(?:"(?P<dq>[^"]*)"|\'(?P<sq>[^\']*)\'|(?P<bare>[^\s>]+)))?'
+)
+SQL_UNSAFE_CHARS = '\'";'
+NOSQL_UNSAFE_CHARS = '$.'
+
+class SanitizePolicy:
+    def __init__(self, allowed_tags=('p', 'br', 'strong', 'em', 'u'), allowed_attributes=('href', 'title'),
+                 html=True, sql=True, nosql=True):
+        self.allowed_tags = frozenset(tag.lower() for tag in allowed_tags)
+        self.allowed_attributes = frozenset(attr.lower() for attr in allowed_attributes)
+        self.html = html
+        strip = (SQL_UNSAFE_CHARS if sql else '') + (NOSQL_UNSAFE_CHARS if nosql else '')
+        self.text_table = str.maketrans('', '', strip)
+        # attribute values are always quoted, so quotes must never survive
+        self.attr_table = str.maketrans('', '', strip + SQL_UNSAFE_CHARS)
+
+class Sanitizer:
+    # Stateless apart from its policy, so one instance can be shared by all
+    # threads. sanitize_many walks dicts, lists, tuples and MultiDict-like
+    # objects and returns the same shape with every string sanitized.
+    def __init__(self, policy=None):
+        self.policy = policy if policy is not None else SanitizePolicy()
+
+    def sanitize(self, value):
+        policy = self.policy
+        if not policy.html or '<' not in value:
+            return value.translate(policy.text_table)
+        allowed_tags = policy.allowed_tags
+        text_table = policy.text_table
+        out = []
+        append = out.append
+        position = 0
+        for match in _SANITIZE_TOKENS.finditer(value):
+            start = match.start()
+            if start > position:
+                append(value[position:start].translate(text_table))
+            position = match.end()
+            tag = match.group('tag')
+            if tag is None:
+                continue
+            tag = tag.lower()
+            if tag not in allowed_tags:
+                continue
+            if match.group('close'):
+                append(f'</{tag}>')
+            else:
+                append(self._start_tag(tag, match.group('attrs')))
+        if position < len(value):
+            append(value[position:].translate(text_table))
+        return ''.join(out)
+
+    def _start_tag(self, tag, attrs):
+        if not attrs or attrs.isspace() or attrs.strip() == '/':
+            return f'<{tag}>'
+        allowed_attributes = self.policy.allowed_attributes
+        attr_table = self.policy.attr_table
+        parts = [tag]
+        for match in _SANITIZE_ATTRS.finditer(attrs):
+            name = match.group('name').lower()
+            if name not in allowed_attributes:
+                continue
+            value = match.group('dq')
+            if value is None:
+                value = match.group('sq')
+            if value is None:
+                value = match.group('bare')
+            parts.append(name if value is None else f'{name}="{value.translate(attr_table)}"')
+        return f'<{" ".join(parts)}>'
+
+    def sanitize_many(self, data):
+        if isinstance(data, str):
+            return self.sanitize(data)
+        # MultiDict subclasses dict; checked first so repeated keys survive
+        lists = getattr(data, 'lists', None)
+        if lists is not None:
+            return type(data)([(key, self.sanitize_many(value)) for key, values in lists() for value in values])
+        if isinstance(data, dict):
+            return {key: self.sanitize_many(value) for key, value in data.items()}
+        if isinstance(data, (list, tuple)):
+            return type(data)(self.sanitize_many(value) for value in data)
+        return data
+
+_sanitizers = {}
+
+def get_sanitizer(sanitize_html=True, sanitize_sql=True, sanitize_nosql=True):
+    key = (sanitize_html, sanitize_sql, sanitize_nosql)
+    sanitizer = _sanitizers.get(key)
+    if sanitizer is None:
+        sanitizer = _sanitizers[key] = Sanitizer(SanitizePolicy(html=sanitize_html, sql=sanitize_sql, nosql=sanitize_nosql))
+    return sanitizer
 
-    if sanitize_nosql:
-        input_string = sanitize_nosql_input(input_string)
+def sanitize_input(input_string, sanitize_html=True, sanitize_sql=True, sanitize_nosql=True):
+    return get_sanitizer(sanitize_html, sanitize_sql, sanitize_nosql).sanitize(input_string)
 
-    return input_string
+def sanitize_many(data, sanitize_html=True, sanitize_sql=True, sanitize_nosql=True):
+    return get_sanitizer(sanitize_html, sanitize_sql, sanitize_nosql).sanitize_many(data)
 
 
 def sanitize_html_input(input_string):
-    input_string = re.sub(r'<script.*?</script>', '', input_string, flags=re.DOTALL)
-    input_string = re.sub(r'<style.*?</style>', '', input_string, flags=re.DOTALL)
-
-    parser = SanitizeHTMLParser(
-        allowed_tags=['p', 'br', 'strong', 'em', 'u'],
-        allowed_attributes=['href', 'title']
-    )
-    parser.feed(input_string)
-
-    return ''.join(parser.sanitized_data)
+    return get_sanitizer(True, False, False).sanitize(input_string)
 
 
 def sanitize_sql_input(input_string):
-    return re.sub(r"[\'\";]", '', input_string)
+    return get_sanitizer(False, True, False).sanitize(input_string)
 
 
 def sanitize_nosql_input(input_string):
-    return input_string.replace('$', '').replace('.', '')
+    return get_sanitizer(False, False, True).sanitize(input_string)
 
 class KEY:
     def __init__(self, node=None, clock_seq=None):
@@ -4,9 +4,10 @@ from werkzeug.datastructures import Headers
 from itsdangerous import URLSafeSerializer
 from werkzeug.exceptions import BadRequest
 import json
+import re
 
 class CORSMiddleware:
-    def __init__(self, app, allowed_origins=None, allowed_methods=None, allowed_headers=None, expose_headers=None, allow_credentials=False, max_age=None):
+    def __init__(self, app, allowed_origins=None, allowed_methods=None, allowed_headers=None, expose_headers=None, allow_credentials=False, max_age=None, preflight_max_age=600, origin_cache_size=1024):
         self.app = app
         self.allowed_origins = allowed_origins or []
         self.allowed_methods = allowed_methods or ['GET', 'POST', 'PUT', 'PATCH', 'DELETE']
@@ -14,32 +15,53 @@ class CORSMiddleware:
         self.expose_headers = expose_headers or []
         self.allow_credentials = allow_credentials
         self.max_age = max_age
+        self.origin_cache_size = origin_cache_size
+
+        # Origins are exact strings, wildcards such as 'https://*.example.com'
+        # or compiled regular expressions.
+        self._allow_any = '*' in self.allowed_origins
+        self._exact_origins = frozenset(o for o in self.allowed_origins if isinstance(o, str) and '*' not in o)
+        self._origin_patterns = tuple(self._compile_origin(o) for o in self.allowed_origins
+                                      if not isinstance(o, str) or ('*' in o and o != '*'))
+        self._origin_verdicts = {}
+
+        headers = [('Access-Control-Allow-Methods', ', '.join(self.allowed_methods))]
+        if self.allowed_headers:
+            headers.append(('Access-Control-Allow-Headers', ', '.join(self.allowed_headers)))
+        if self.expose_headers:
+            headers.append(('Access-Control-Expose-Headers', ', '.join(self.expose_headers)))
+        if self.allow_credentials:
+            headers.append(('Access-Control-Allow-Credentials', 'true'))
+        if self.max_age is not None:
+            headers.append(('Access-Control-Max-Age', str(self.max_age)))
+        # Apply additional security headers
+        headers.append(('Strict-Transport-Security', 'max-age=31536000; includeSubDomains'))
+        headers.append(('Vary', 'Origin'))
+        self._cors_headers = tuple(headers)
+
+        preflight_age = self.max_age if self.max_age is not None else preflight_max_age
+        preflight = [header for header in headers if header[0] != 'Access-Control-Max-Age']
+        if preflight_age is not None:
+            preflight.append(('Access-Control-Max-Age', str(preflight_age)))
+        preflight.append(('Content-Length', '0'))
+        self._preflight_headers = tuple(preflight)
+
+    @staticmethod
+    def _compile_origin(origin):
+        if not isinstance(origin, str):
+            return origin
+        return re.compile('[^/]*'.join(re.escape(part) for part in origin.split('*')))
 
     def __call__(self, environ, start_response):
-        def custom_start_response(status, headers, exc_info=None):
-            origin = environ.get('HTTP_ORIGIN')
-            if self.is_valid_origin(origin):
-                headers.append(('Access-Control-Allow-Origin', origin))
-            else:
-                headers.append(('Access-Control-Allow-Origin', 'null'))
-
-            headers.append(('Access-Control-Allow-Methods', ', '.join(self.allowed_methods)))
-
-            if self.allowed_headers:
-                headers.append(('Access-Control-Allow-Headers', ', '.join(self.allowed_headers)))
-
-            if self.expose_headers:
-                headers.append(('Access-Control-Expose-Headers', ', '.join(self.expose_headers)))
-
-            if self.allow_credentials:
-                headers.append(('Access-Control-Allow-Credentials', 'true'))
+        origin = environ.get('HTTP_ORIGIN')
+        allow_origin = ('Access-Control-Allow-Origin', origin if origin and self.is_valid_origin(origin) else 'null')
 
-            if self.max_age is not None:
-                headers.append(('Access-Control-Max-Age', str(self.max_age)))
-
-            # Apply additional security headers
-            headers.append(('Strict-Transport-Security', 'max-age=31536000; includeSubDomains'))
+        if environ.get('REQUEST_METHOD') == 'OPTIONS' and 'HTTP_ACCESS_CONTROL_REQUEST_METHOD' in environ:
+            return self.handle_options_request(environ, start_response, allow_origin)
 
+        def custom_start_response(status, headers, exc_info=None):
+            headers.append(allow_origin)
+            headers.extend(self._cors_headers)
             return start_response(status, headers, exc_info)
 
         try:
@@ -69,15 +91,31 @@ class CORSMiddleware:
         }
         return wrap_file(environ, [json.dumps(error_response)], f'{status_code} {error_message}', response_headers)
 
-    def handle_options_request(self, environ):
-        response_headers = Headers()
-        response_headers.add('Content-Type', 'text/plain')
-        return wrap_file(environ, ['OK'], '200 OK', response_headers)
+    def handle_options_request(self, environ, start_response, allow_origin=None):
+        # CORS preflight, answered here without calling the app.
+        if allow_origin is None:
+            origin = environ.get('HTTP_ORIGIN')
+            allow_origin = ('Access-Control-Allow-Origin', origin if origin and self.is_valid_origin(origin) else 'null')
+        headers = [allow_origin]
+        headers.extend(self._preflight_headers)
+        start_response('204 No Content', headers)
+        return []
 
     def is_valid_origin(self, origin):
-        if '*' in self.allowed_origins:
+        if self._allow_any:
+            return True
+        if origin in self._exact_origins:
             return True
-        return origin in self.allowed_origins
+        if not self._origin_patterns or not origin:
+            return False
+        verdict = self._origin_verdicts.get(origin)
+        if verdict is None:
+            # fullmatch: a user-supplied regex is anchored at both ends too
+            verdict = any(pattern.fullmatch(origin) for pattern in self._origin_patterns)
+            if len(self._origin_verdicts) >= self.origin_cache_size:
+                self._origin_verdicts.clear()
+            self._origin_verdicts[origin] = verdict
+        return verdict
 
     def prevent_csrf(self, environ):
         referer = environ.get('HTTP_REFERER')
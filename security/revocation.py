@@ -0,0 +1,197 @@
+import heapq
+import json
+import os
+import threading
+import time
+from ..contrib.shared_files import SharedFile
+
+class RevocationStore:
+    # Revoked token ids with their expiry. Lookups are a dict probe; entries
+    # are pruned once the token would have expired anyway, using a heap
+    # ordered by exp. When path is given, every revocation is also appended
+    # to a log file that all workers on the host share: each store replays
+    # records it has not seen yet at most every refresh_interval seconds,
+    # and the log is rewritten without expired records on compact().
+    def __init__(self, path=None, refresh_interval=1.0, default_ttl=None, compact_threshold=10000):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.default_ttl = default_ttl
+        self.compact_threshold = compact_threshold
+        self._revoked = {}
+        self._expiries = []
+        self._lock = threading.Lock()
+        self._log = None
+        self._inode = None
+        self._offset = 0
+        self._pending = b''
+        self._last_refresh = 0.0
+        self._dead_records = 0
+        if path is not None:
+            self._open()
+            self._refresh(force=True)
+
+    def _open(self):
+        # SharedFile also reopens the log in forked workers, so that flock
+        # excludes them from each other; a log compacted meanwhile is then
+        # picked up by the inode check in _refresh.
+        if self._log is None:
+            self._log = SharedFile(self.path, append=True)
+        else:
+            self._log.reopen()
+        self._inode = os.fstat(self._log.fileno()).st_ino
+        self._offset = 0
+        self._pending = b''
+        self._dead_records = 0
+
+    def _log_lock(self):
+        return self._log.lock()
+
+    def _append(self, records, jti, expires):
+        # Retries when another worker swapped in a compacted log between our
+        # last refresh and taking the lock, so no record lands in the old file.
+        # Reopening rebuilds the set from the new log, which does not have
+        # this record yet, so it is added back.
+        while True:
+            with self._log_lock():
+                if os.stat(self.path).st_ino == self._inode:
+                    self._log.file.write(records)
+                    return
+            self._refresh(force=True)
+            self._add(jti, expires)
+
+    def _expiry(self, exp):
+        if exp is not None:
+            return float(exp)
+        if self.default_ttl is not None:
+            return time.time() + self.default_ttl
+        return None
+
+    def _add(self, jti, expires, revoked=None, expiries=None):
+        revoked = self._revoked if revoked is None else revoked
+        if jti in revoked:
+            return False
+        revoked[jti] = expires
+        if expires is not None:
+            heapq.heappush(self._expiries if expiries is None else expiries, (expires, jti))
+        return True
+
+    def _refresh(self, force=False):
+        # Replays records appended by other workers; reopens the log when
+        # another worker has compacted it into a new file.
+        now = time.monotonic()
+        if not force and now - self._last_refresh < self.refresh_interval:
+            return
+        self._last_refresh = now
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            inode = None
+        reopened = inode != self._inode
+        if reopened:
+            self._open()
+        size = os.fstat(self._log.fileno()).st_size
+        if size <= self._offset and not reopened:
+            return
+        data = os.pread(self._log.fileno(), size - self._offset, self._offset) if size > self._offset else b''
+        self._offset += len(data)
+        data = self._pending + data
+        lines = data.split(b'\n')
+        # a record still being written stays pending until its newline lands
+        self._pending = lines.pop()
+        # A new log replaces the whole set. It is rebuilt off to the side and
+        # swapped in, so lock-free readers never see it empty or half-built.
+        revoked, expiries = ({}, []) if reopened else (None, None)
+        now = time.time()
+        for line in lines:
+            if not line:
+                continue
+            jti, expires = json.loads(line)
+            if expires is not None and expires < now:
+                self._dead_records += 1
+                continue
+            self._add(jti, expires, revoked, expiries)
+        if reopened:
+            self._revoked, self._expiries = revoked, expiries
+
+    def revoke(self, jti, exp=None):
+        # Returns False when jti was already revoked. Tokens that have already
+        # expired are rejected by decode anyway and are not recorded.
+        expires = self._expiry(exp)
+        if expires is not None and expires < time.time():
+            return True
+        with self._lock:
+            if self._log is not None:
+                self._refresh(force=True)
+            if not self._add(jti, expires):
+                return False
+            if self._log is not None:
+                self._append(json.dumps([jti, expires], separators=(',', ':')).encode('utf-8') + b'\n', jti, expires)
+            self._prune_locked(time.time())
+            return True
+
+    def is_revoked(self, jti):
+        if self._log is not None and time.monotonic() - self._last_refresh >= self.refresh_interval:
+            with self._lock:
+                self._refresh()
+        expires = self._revoked.get(jti, False)
+        if expires is False:
+            return False
+        return expires is None or expires >= time.time()
+
+    __contains__ = is_revoked
+
+    def _prune_locked(self, now):
+        expiries = self._expiries
+        pruned = 0
+        while expiries and expiries[0][0] < now:
+            expires, jti = heapq.heappop(expiries)
+            if self._revoked.get(jti) == expires:
+                del self._revoked[jti]
+                pruned += 1
+        self._dead_records += pruned
+        return pruned
+
+    def prune(self):
+        with self._lock:
+            pruned = self._prune_locked(time.time())
+            if self._log is not None and self._dead_records >= max(self.compact_threshold, len(self._revoked)):
+                self._compact_locked()
+            return pruned
+
+    def _compact_locked(self):
+        # Rewrites the log with live records only and swaps it in atomically;
+        # other workers notice the new inode on their next refresh.
+        while True:
+            self._refresh(force=True)
+            with self._log_lock():
+                if os.stat(self.path).st_ino != self._inode:
+                    continue  # compacted by another worker meanwhile
+                # records appended after the refresh above but before the lock
+                self._refresh(force=True)
+                self._prune_locked(time.time())
+                temp_path = f'{self.path}.{os.getpid()}.tmp'
+                with open(temp_path, 'wb') as f:
+                    for jti, expires in self._revoked.items():
+                        f.write(json.dumps([jti, expires], separators=(',', ':')).encode('utf-8') + b'\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+                break
+        self._refresh(force=True)
+
+    def compact(self):
+        if self._log is None:
+            return
+        with self._lock:
+            self._compact_locked()
+
+    def __len__(self):
+        return len(self._revoked)
+
+    def stats(self):
+        return {'revoked': len(self._revoked), 'dead_records': self._dead_records}
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None